@@ -0,0 +1,61 @@
+import argparse
+import random
+import time
+from itertools import cycle, islice
+
+import osr
+import raster
+from multi_image import Renderer, pick_color
+
+
+def time_draw(replays, frames, backend="pil", tail=100, radius=5):
+    """Seconds per frame multi_image.py takes to draw frames of replays."""
+    renderer = Renderer(replays, "benchmark", tail, radius, True, backend)
+    start = min(renderer.frames // 2, max(renderer.frames - frames, 0))
+    end = min(start + frames, renderer.frames)
+    started = time.perf_counter()
+    for frame, im in renderer.draw(start, end):
+        pass
+    return (time.perf_counter() - started) / max(end - start, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="time multi_image.py frames against the number of replays"
+    )
+    parser.add_argument("paths", nargs="+", help="replays or folders containing them")
+    parser.add_argument(
+        "-n",
+        "--counts",
+        help="numbers of replays to draw (default 1 2 4 ... up to 256)",
+        type=int,
+        nargs="+",
+        default=[2**i for i in range(9)],
+    )
+    parser.add_argument(
+        "--frames", help="frames to draw at each count", type=int, default=300
+    )
+    parser.add_argument(
+        "--backend",
+        help="how frames are drawn",
+        choices=raster.BACKENDS,
+        default="pil",
+    )
+    parser.add_argument("-t", "--tail", type=int, default=100)
+    parser.add_argument("-r", "--radius", type=int, default=5)
+    args = parser.parse_args()
+
+    paths = list(osr.find_replays(args.paths, recursive=False))
+    rng = random.Random(0)
+    print("replays  ms/frame  us/frame/replay")
+    for count in args.counts:
+        # files are read more than once when there are fewer than count
+        replays = [osr.read_file(path, True) for path in islice(cycle(paths), count)]
+        for replay in replays:
+            replay.color = pick_color(rng)
+        seconds = time_draw(replays, args.frames, args.backend, args.tail, args.radius)
+        print("%7d  %8.2f  %15.1f" % (count, seconds * 1000, seconds * 1e6 / count))
+
+
+if __name__ == "__main__":
+    main()
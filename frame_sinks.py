@@ -0,0 +1,313 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+
+import PIL.Image
+
+# Sinks take rendered frames as PIL images. Rendering can be split over
+# processes, so each sink has an encode step that can run wherever the frame
+# was drawn and a write step that runs where the sink was opened. Ordered
+# sinks are streams whose frames have to be written one after another in the
+# parent process; image sequences can be written by any process in any order.
+
+FORMATS = ("tga", "png", "raw", "y4m")
+
+
+def rgb24(im):
+    """The pixels of an RGB image, packed row by row."""
+    return im.tobytes()
+
+
+def y4m_frame(im):
+    """A Y4M frame of an RGB image: full range 4:4:4 Y, Cb and Cr planes."""
+    return b"".join(
+        [b"FRAME\n"] + [band.tobytes() for band in im.convert("YCbCr").split()]
+    )
+
+
+class Sink:
+    """Where rendered frames go.
+
+    write gets whatever encode returned for a frame, and gets the frames in
+    order if ordered is set.
+    """
+
+    ordered = False
+
+    def encode(self, im):
+        return im
+
+    def write(self, frame, data):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Manifest:
+    """A record of the frames of an image sequence that have been written.
+
+    It's a file of json lines: the settings the frames were rendered with,
+    then a line with the file name and size of each frame once it's saved.
+    Lines are appended whole, so processes writing frames to the same folder
+    can share one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """The settings recorded and the (file, size) of each frame written."""
+        settings = None
+        frames = {}
+        try:
+            f = open(self.path)
+        except FileNotFoundError:
+            return settings, frames
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut short by a crash
+                    continue
+                if "settings" in entry:
+                    settings = entry["settings"]
+                else:
+                    frames[entry["frame"]] = (entry["file"], entry["size"])
+        return settings, frames
+
+    def start(self, settings, resume=False):
+        """Start recording frames rendered with settings.
+
+        The manifest is started over if it has different settings, unless
+        resuming, which raises ValueError instead. When resuming, returns the
+        frames that were written and whose files are still the same size.
+        """
+        settings = json.loads(json.dumps(settings))
+        old, frames = self.read()
+        if old != settings:
+            if resume and old is not None:
+                raise ValueError("%s has different settings" % self.path)
+            with open(self.path, "w") as f:
+                f.write(json.dumps({"settings": settings}) + "\n")
+            frames = {}
+        if not resume:
+            return set()
+        folder = os.path.dirname(self.path)
+        done = set()
+        for frame, (name, size) in frames.items():
+            try:
+                if os.path.getsize(os.path.join(folder, name)) == size:
+                    done.add(frame)
+            except OSError:
+                pass
+        return done
+
+    def add(self, frame, path):
+        """Record that frame was saved to path."""
+        entry = {
+            "frame": frame,
+            "file": os.path.basename(path),
+            "size": os.path.getsize(path),
+        }
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+class ImageSequence(Sink):
+    """Each frame saved to folder as its own <basename>-<frame>.<format> file.
+
+    Saved frames are recorded in the Manifest <basename>.manifest in folder.
+    """
+
+    def __init__(self, folder, basename, format="tga", **params):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.basename = basename
+        self.format = format
+        self.params = params
+        self.manifest = Manifest(os.path.join(folder, basename + ".manifest"))
+
+    def write(self, frame, im):
+        name = "%s-%05d.%s" % (self.basename, frame, self.format)
+        path = os.path.join(self.folder, name)
+        im.save(path, **self.params)
+        self.manifest.add(frame, path)
+
+
+class Stream(Sink):
+    """Frames written one after another to a file, named pipe or stdout (-)."""
+
+    ordered = True
+
+    def __init__(self, path):
+        if path == "-":
+            self.f = sys.stdout.buffer
+        else:
+            self.f = open(path, "wb")
+
+    def write(self, frame, data):
+        self.f.write(data)
+
+    def close(self):
+        if self.f is sys.stdout.buffer:
+            self.f.flush()
+        else:
+            self.f.close()
+
+
+class RawVideo(Stream):
+    """Headerless rgb24 frames, e.g. for ffmpeg -f rawvideo -pix_fmt rgb24."""
+
+    encode = staticmethod(rgb24)
+
+
+class Y4mVideo(Stream):
+    """A YUV4MPEG2 stream, which carries its own size and frame rate."""
+
+    encode = staticmethod(y4m_frame)
+
+    def __init__(self, path, width, height, fps):
+        super().__init__(path)
+        rate = Fraction(fps).limit_denominator(1001)
+        self.f.write(
+            b"YUV4MPEG2 W%d H%d F%d:%d Ip A1:1 C444 XCOLORRANGE=FULL\n"
+            % (width, height, rate.numerator, rate.denominator)
+        )
+
+
+class Pipeline:
+    """Encodes and writes frames to a sink on background threads.
+
+    Frames are drawn into one of a fixed set of reusable images taken with
+    buffer(), which blocks while they're all still waiting to be written, so
+    memory stays bounded when writing is the slow part. Ordered sinks still
+    get their frames in the order they were submitted.
+
+    wait_time is how long buffer() blocked and write_time is the thread time
+    spent encoding and writing.
+    """
+
+    def __init__(self, sink, size, threads=2, buffers=None):
+        self.sink = sink
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(threads)
+        self.free = queue.Queue()
+        for i in range(buffers or threads * 2):
+            self.free.put(PIL.Image.new("RGB", size))
+        self.futures = deque()
+        self.written = None
+        self.failed = False
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.wait_time = 0.0
+        self.write_time = 0.0
+
+    def buffer(self):
+        """An image to draw the next frame into."""
+        started = time.perf_counter()
+        im = self.free.get()
+        self.wait_time += time.perf_counter() - started
+        return im
+
+    def submit(self, frame, im):
+        """Write im, which came from buffer(), as frame."""
+        # raise any error from earlier frames as soon as it's seen
+        while self.futures and self.futures[0].done():
+            self.futures.popleft().result()
+        before, self.written = self.written, threading.Event()
+        future = self.pool.submit(self._write, frame, im, before, self.written)
+        self.futures.append(future)
+        self.frames += 1
+
+    def _write(self, frame, im, before, written):
+        started = time.perf_counter()
+        try:
+            data = self.sink.encode(im)
+            if self.sink.ordered:
+                # data doesn't need im, which can be drawn into again
+                self.free.put(im)
+                im = None
+                elapsed = time.perf_counter() - started
+                if before is not None:
+                    before.wait()
+                if self.failed:
+                    # an earlier frame is missing, don't write any after it
+                    return
+                started = time.perf_counter()
+                self.sink.write(frame, data)
+            else:
+                self.sink.write(frame, data)
+                elapsed = 0
+        except BaseException:
+            self.failed = True
+            raise
+        finally:
+            if im is not None:
+                self.free.put(im)
+            written.set()
+        with self.lock:
+            self.write_time += elapsed + time.perf_counter() - started
+
+    def close(self):
+        """Wait for every frame to be written."""
+        try:
+            while self.futures:
+                self.futures.popleft().result()
+        finally:
+            # frames after one that failed are dropped
+            for future in self.futures:
+                future.cancel()
+            self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_arguments(parser):
+    """Add the options for picking a sink to parser."""
+    parser.add_argument(
+        "--format", help="output format (default tga)", choices=FORMATS, default="tga"
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="folder for tga and png frames (default out), "
+        "file or named pipe for raw and y4m (default - for stdout)",
+    )
+    parser.add_argument(
+        "--png-compression",
+        help="png compression level, 0-9",
+        type=int,
+        choices=range(10),
+        default=6,
+        metavar="LEVEL",
+    )
+
+
+def open_sink(args, basename, width, height, fps):
+    """The sink picked by the options from add_arguments."""
+    if args.format == "raw":
+        return RawVideo(args.output or "-")
+    if args.format == "y4m":
+        return Y4mVideo(args.output or "-", width, height, fps)
+    params = {}
+    if args.format == "png":
+        params["compress_level"] = args.png_compression
+    return ImageSequence(args.output or "out", basename, args.format, **params)
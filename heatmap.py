@@ -0,0 +1,175 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import numpy as np
+import PIL.Image
+
+import osr
+from playfield import PLAYFIELD_HEIGHT, PLAYFIELD_WIDTH
+
+# replay paths read and binned by a worker before it sends its histogram back
+BATCH = 32
+
+
+class Heatmap:
+    """A 2D histogram of cursor positions over the 512x384 playfield.
+
+    There are resolution bins per osu! pixel each way. hist is indexed
+    [y, x] and replays counts the replays added.
+    """
+
+    def __init__(self, resolution=1):
+        self.resolution = resolution
+        self.hist = np.zeros(
+            (PLAYFIELD_HEIGHT * resolution, PLAYFIELD_WIDTH * resolution)
+        )
+        self.replays = 0
+
+    def add(self, replay, start=None, end=None, keys=None, weighted=False):
+        """Bin a replay's cursor positions.
+
+        Only frames current at some point from start to end ms count, and
+        with keys only the ones holding any of those key bits (see
+        osr.key_mask).
+        Each frame counts once, or with weighted=True, for the number of ms it
+        was current. Positions off the playfield aren't counted.
+        """
+        t = replay.time_index
+        mask = np.ones(len(t), bool)
+        if replay.seed is not None:
+            # the last frame is the record holding the rng seed, not a position
+            mask[-1] = False
+        if keys is not None:
+            mask &= replay.key_mask & keys != 0
+        if weighted:
+            # a frame is current until the next one, the last one not at all
+            lo = t
+            hi = np.append(t[1:], t[-1:])
+            if start is not None:
+                lo = np.maximum(lo, start)
+            if end is not None:
+                hi = np.minimum(hi, end)
+            weights = np.maximum(hi - lo, 0)
+            mask &= weights > 0
+        else:
+            weights = None
+            if start is not None:
+                mask &= np.append(t[1:], np.iinfo(t.dtype).max) > start
+            if end is not None:
+                mask &= t < end
+
+        height, width = self.hist.shape
+        x = np.floor(replay.x * self.resolution).astype(np.intp)
+        y = np.floor(replay.y * self.resolution).astype(np.intp)
+        mask &= (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        index = (y * width + x)[mask]
+        if weights is not None:
+            weights = weights[mask]
+        self.hist += np.bincount(index, weights, width * height).reshape(height, width)
+        self.replays += 1
+
+    def __iadd__(self, other):
+        self.hist += other.hist
+        self.replays += other.replays
+        return self
+
+    def image(self, gamma=0.5):
+        """The histogram as a black to red to yellow to white image.
+
+        Counts are scaled to the largest one and raised to gamma, so with the
+        default the quieter areas still show up.
+        """
+        peak = self.hist.max()
+        v = (self.hist / peak) ** gamma if peak else self.hist
+        rgb = np.clip(np.stack([v * 3, v * 3 - 1, v * 3 - 2], axis=-1), 0, 1)
+        return PIL.Image.fromarray((rgb * 255).astype(np.uint8))
+
+
+def _accumulate(paths, resolution, flip_hr, options):
+    heatmap = Heatmap(resolution)
+    errors = []
+    for path in paths:
+        try:
+            heatmap.add(osr.read_file(path, flip_hr), **options)
+        except Exception as e:
+            errors.append((path, e))
+    return heatmap, errors
+
+
+def accumulate(paths, resolution=1, flip_hr=True, workers=None, **options):
+    """A Heatmap of every replay at paths, binned in worker processes.
+
+    options are passed on to Heatmap.add. Replays are read and binned in
+    batches of BATCH, with only a few batches in flight at once, so memory
+    doesn't grow with the number of replays. Returns the heatmap and the
+    files that couldn't be read and their errors.
+    """
+    heatmap = Heatmap(resolution)
+    errors = []
+    paths = iter(paths)
+    batches = iter(lambda: list(islice(paths, BATCH)), [])
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool:
+
+        def submit(batch):
+            return pool.submit(_accumulate, batch, resolution, flip_hr, options)
+
+        for _, future in osr.windowed(submit, batches, workers * 2):
+            part, part_errors = future.result()
+            heatmap += part
+            errors += part_errors
+    return heatmap, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="osu! replay cursor heatmaps")
+    parser.add_argument("paths", nargs="+", help="replays or folders containing them")
+    parser.add_argument("-o", "--output", help="image to write", default="heatmap.png")
+    parser.add_argument("-a", "--array", help="also save the histogram as .npy")
+    parser.add_argument(
+        "-r", "--resolution", help="bins per osu! pixel", type=int, default=1
+    )
+    parser.add_argument("--start", help="only from this time (ms)", type=int)
+    parser.add_argument("--end", help="only up to this time (ms)", type=int)
+    parser.add_argument(
+        "-p", "--pressed", help="only while a key is held", action="store_true"
+    )
+    parser.add_argument(
+        "-w",
+        "--weighted",
+        help="count the time spent at each position, not frames",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-g", "--gamma", help="image brightness curve", type=float, default=0.5
+    )
+    parser.add_argument(
+        "-f", "--no-flip", help="don't flip hr plays", dest="flip", action="store_false"
+    )
+    parser.add_argument("-j", "--workers", help="processes to use", type=int)
+    args = parser.parse_args()
+
+    heatmap, errors = accumulate(
+        osr.find_replays(args.paths),
+        args.resolution,
+        args.flip,
+        args.workers,
+        start=args.start,
+        end=args.end,
+        keys=osr.K1 | osr.K2 | osr.M1 | osr.M2 if args.pressed else None,
+        weighted=args.weighted,
+    )
+    for path, error in errors:
+        sys.stderr.write("%s: %s\n" % (path, error))
+    print("binned %d replays" % heatmap.replays)
+
+    heatmap.image(args.gamma).save(args.output)
+    if args.array:
+        np.save(args.array, heatmap.hist)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,159 +1,476 @@
 import argparse
 import glob
-import math
 import os.path
 import random
 import sys
 import time
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-import PIL.Image
-import PIL.ImageDraw
-from recordclass import recordclass
+import numpy as np
 
+import frame_sinks
 import osr
+import playfield
+import raster
+import replay_cache
+import replay_index
+from playfield import Playfield
+from timeline import Timeline
 
 BLACK = (0, 0, 0)
 GRAY = (100, 100, 100)
 WHITE = (255, 255, 255)
 
-
-def pick_color():
-    return tuple(random.randrange(64, 256) for i in range(3))
-
-
-parser = argparse.ArgumentParser(description="osu! replay visualizer")
-parser.add_argument("path", help="folder containing replays and mp3")
-parser.add_argument("-t", "--tail", help="tail length", type=int, default=100)
-parser.add_argument("-r", "--radius", help="circle radius", type=int, default=5)
-parser.add_argument(
-    "-w",
-    "--no-wipe",
-    help="don't wipe the screen each frame",
-    dest="wipe",
-    action="store_false",
-)
-parser.add_argument(
-    "-f", "--no-flip", help="don't flip hr plays", dest="flip", action="store_false"
-)
-args = parser.parse_args()
-
-pathname = args.path
-tail = args.tail
-radius = args.radius
-wipe = args.wipe
-flip = args.flip
-
-basename = os.path.basename(pathname)
-
-files = glob.glob(os.path.join(pathname, "*.osr"))
-if len(files) == 0:
-    sys.exit("no replays to read")
-
-replays = []
-
-for name in files:
-    replay = osr.read_file(name, flip)
-    replays.append(replay)
-
-replays.sort()
-
-n = len(replays)
-for r in replays:
-    print("%2d. %15s - %d" % (n, r.player, r.score))
-    n -= 1
-print("read %d replays" % len(replays))
-
-State = recordclass("State", "replay color x y z trail")
-states = []
-
-for replay in replays:
-    # we don't need anything else on the replay object so remove the references
-    replay = replay.replay
-    color = WHITE if len(replays) == 1 else pick_color()
-    states.append(State(replay, color, 0, 0, 0, deque()))
-
-del replays
-
 HEIGHT = 768
 WIDTH = 1366
-KEYSIZE = min((WIDTH - 1024) / 5, HEIGHT / len(states))
-
-
-def scale(x, y):
-    return x * 2, y * 2
-
-
-interval = 1000 / 60
-frame = 0
-last_pos = 0
-done = False
-clock = deque(maxlen=100)
-
-msec = 0
-
-for state in states:
-    for p in state.replay:
-        if p.t > msec:
-            msec = p.t
-
-frames = math.ceil(msec / interval)
-
-mins, secs = divmod(frames // 60, 60)
-print(f"{frames} frames total -> {mins}m{secs:2d}s")
-
-im = PIL.Image.new("RGB", (WIDTH, HEIGHT))
-
-for frame in range(frames):
-    clock.append(time.monotonic())
-    pos = int(frame * interval)
-    if not wipe:
-        im = PIL.Image.new("RGB", (WIDTH, HEIGHT))
-    draw = PIL.ImageDraw.Draw(im)
-
-    lines = []
-    circles = []
-    rects = []
-
-    for i, state in enumerate(states):
-        r = state.replay
-        trail = state.trail
-        color = state.color
-        while r and r[0].t <= pos:
-            p = r.popleft()
-            state.x, state.y, state.z = p.x, p.y, p.z
-            circles.append((scale(state.x, state.y), color))
-            trail.append(p)
-        o = (scale(state.x, state.y), color)
-        if o not in circles:
-            circles.append(o)
-        while trail and (pos - trail[0].t) > tail:
-            trail.popleft()
-        if len(trail) > 1:
-            points = [scale(p.x, p.y) for p in trail]
-            lines.append((points, color))
-        y = i * KEYSIZE
-        for j, o in enumerate(osr.keys(state.z)):
-            x = WIDTH - KEYSIZE * 5 + j * KEYSIZE
-            rects.append(((x, y, x + KEYSIZE, y + KEYSIZE), color if o else BLACK))
-
-    if tail:
-        for points, color in lines:
-            draw.line(points, color, 2)
-
-    if radius:
-        for (x, y), color in circles:
-            draw.ellipse((x - radius, y - radius, x + radius, y + radius), color, BLACK)
-
-    for rect, color in rects:
-        draw.rectangle(rect, color)
-
-    del draw
-
-    im.save(os.path.join("out", "%s-%05d.tga" % (basename, frame)))
-
-    if frame % 10 == 0:
-        d = clock[-1] - clock[0]
-        if d:
-            fps = len(clock) / d
-            sys.stderr.write("%5d - %5.0f fps - %.4f\r" % (frame, fps, frame / frames))
+FPS = 60
+
+# frames per chunk handed to a worker with --workers, and per block of
+# timeline rows turned into lists while drawing
+CHUNK = 120
+# frames per chunk for ordered sinks, whose workers send back whole encoded
+# frames that wait in the parent until the chunks before them are written
+ORDERED_CHUNK = 2
+
+
+def pick_color(rng=random):
+    return tuple(rng.randrange(64, 256) for i in range(3))
+
+
+def runs(frames):
+    """(start, end) ranges covering the ascending frame numbers in frames."""
+    ranges = []
+    for frame in frames:
+        if ranges and ranges[-1][1] == frame:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([frame, frame + 1])
+    return [tuple(r) for r in ranges]
+
+
+class Renderer:
+    """Draws the frames of a set of replays.
+
+    Where every cursor and trail is at each frame comes from a Timeline, so
+    any range of frames can be rendered on its own.
+    """
+
+    def __init__(
+        self,
+        replays,
+        basename,
+        tail,
+        radius,
+        wipe,
+        backend="pil",
+        size=(WIDTH, HEIGHT),
+        fps=FPS,
+        keys=True,
+    ):
+        self.replays = replays
+        self.basename = basename
+        self.tail = tail
+        self.radius = radius
+        self.wipe = wipe
+        self.backend = backend
+        self.size = size
+        self.keys = keys
+        self.timeline = Timeline(replays, fps)
+        self.interval = self.timeline.interval
+        self.frames = len(self.timeline)
+        self.keysize = playfield.keysize(*size, len(replays))
+        self.playfield = Playfield.fit(size[1])
+        # every replay's cursor positions on the image
+        self.points = [
+            np.column_stack(
+                self.playfield(replay.x.astype(float), replay.y.astype(float))
+            )
+            for replay in replays
+        ]
+        self._boxes = None
+
+    def draw(self, start, end, buffer=None):
+        """Yield frame numbers and images for frames start to end (exclusive).
+
+        buffer is an optional function returning an image to draw each frame
+        into; without it, an image may only be good until the next one is
+        yielded. Without wipe each frame is drawn over the one before it.
+        """
+        previous = self.timeline.previous(start).tolist()
+        colors = [replay.color for replay in self.replays]
+        tail = self.tail
+        radius = self.radius
+        canvas = raster.BACKENDS[self.backend](*self.size)
+
+        boxes = self._key_boxes()
+
+        # reused from frame to frame
+        lines = []
+        circles = []
+        rects = []
+        # the circles in circles, to skip cursors already drawn in O(1)
+        drawn = set()
+
+        for frame, (index, trail_start, x, y, mask) in zip(
+            range(start, end), self._rows(start, end)
+        ):
+            if self.wipe:
+                canvas.clear()
+            lines.clear()
+            circles.clear()
+            rects.clear()
+            drawn.clear()
+
+            for i, points in enumerate(self.points):
+                color = colors[i]
+                # the replay frames that became current since the last frame
+                a, b = previous[i] + 1, index[i] + 1
+                if a < b:
+                    new = [(p, color) for p in map(tuple, points[a:b].tolist())]
+                    circles.extend(new)
+                    drawn.update(new)
+                o = ((x[i], y[i]), color)
+                if o not in drawn:
+                    circles.append(o)
+                    drawn.add(o)
+                if b - trail_start[i] > 1:
+                    lines.append((points[trail_start[i] : b], color))
+                if self.keys:
+                    rects.extend(boxes[i][mask[i]])
+            previous = index
+
+            if tail:
+                canvas.lines(lines, 2)
+
+            if radius:
+                canvas.circles(circles, radius)
+
+            canvas.rects(rects)
+
+            yield frame, canvas.image(buffer and buffer())
+
+    def _key_boxes(self):
+        """Every replay's key boxes for every key mask.
+
+        They're made the first time they're needed rather than for every range
+        drawn, since workers draw many short ones.
+        """
+        if self._boxes is None:
+            keysize = self.keysize
+            left = self.size[0] - keysize * 5
+            self._boxes = []
+            for i, replay in enumerate(self.replays):
+                y = i * keysize
+                rects = [
+                    (x, y, x + keysize, y + keysize)
+                    for x in (left + j * keysize for j in range(5))
+                ]
+                self._boxes.append(
+                    [
+                        [
+                            (rect, replay.color if mask & key else BLACK)
+                            for rect, key in zip(rects, osr.KEYS)
+                        ]
+                        for mask in range(1 << len(osr.KEYS))
+                    ]
+                )
+        return self._boxes
+
+    def _rows(self, start, end):
+        """Yield the index, trail start, x, y and key mask lists of each frame.
+
+        Lists are faster to draw from than arrays but much bigger, so they're
+        made CHUNK frames at a time rather than for the whole range.
+        """
+        timeline = self.timeline
+        for first in range(start, end, CHUNK):
+            rows = slice(
+                first - timeline.start, min(first + CHUNK, end) - timeline.start
+            )
+            xs, ys = self.playfield(
+                timeline.x[rows].astype(float), timeline.y[rows].astype(float)
+            )
+            yield from zip(
+                timeline.index[rows].tolist(),
+                timeline.trail_start(self.tail, rows).tolist(),
+                xs.tolist(),
+                ys.tolist(),
+                timeline.keys[rows].tolist(),
+            )
+
+    def render(self, ranges, sink, progress=False, threads=2):
+        """Render the frames in each (start, end) range of ranges to sink.
+
+        Frames are encoded and written on threads while the next ones are
+        drawn. With progress, how long each of those took is shown at the end.
+        """
+        clock = deque(maxlen=100)
+        started = time.perf_counter()
+        with frame_sinks.Pipeline(sink, self.size, threads) as pipeline:
+            for start, end in ranges:
+                for frame, im in self.draw(start, end, pipeline.buffer):
+                    pipeline.submit(frame, im)
+                    clock.append(time.monotonic())
+                    if progress and frame % 10 == 0:
+                        d = clock[-1] - clock[0]
+                        if d:
+                            fps = len(clock) / d
+                            sys.stderr.write(
+                                "%5d - %5.0f fps - %.4f\r"
+                                % (frame, fps, frame / self.frames)
+                            )
+            drawing = time.perf_counter() - started - pipeline.wait_time
+        if progress and pipeline.frames:
+            elapsed = time.perf_counter() - started
+            n = pipeline.frames
+            sys.stderr.write(
+                "\n%d frames in %.1fs: drawing %.1f ms/frame, "
+                "writing %.1f ms/frame on %d threads, %.1fs waiting for writes\n"
+                % (
+                    n,
+                    elapsed,
+                    drawing / n * 1000,
+                    pipeline.write_time / n * 1000,
+                    threads,
+                    pipeline.wait_time,
+                )
+            )
+
+
+_renderer = None
+_encode = None
+_sink = None
+
+
+def _init_worker(renderer, encode, sink):
+    global _renderer, _encode, _sink
+    _renderer = renderer
+    _encode = encode
+    _sink = sink
+
+
+def _render(start, end):
+    images = _renderer.draw(start, end)
+    if _sink is None:
+        return [_encode(im) for _, im in images]
+    for frame, im in images:
+        _sink.write(frame, _encode(im))
+
+
+def render_parallel(renderer, sink, workers, ranges):
+    """Render the frames in ranges to sink, in chunks over worker processes.
+
+    Workers write to unordered sinks themselves; for ordered ones they send
+    back encoded frames, which are written here one chunk at a time. Those
+    chunks are kept to a few frames, since each can be megabytes.
+    """
+    frames = sum(end - start for start, end in ranges)
+    initargs = (renderer, sink.encode, None if sink.ordered else sink)
+    size = ORDERED_CHUNK if sink.ordered else CHUNK
+    # one chunk per worker for ordered sinks so at most that many frames are
+    # finished but unwritten, otherwise a couple so workers aren't kept waiting
+    window = workers if sink.ordered else workers * 2
+    chunks = iter(
+        (start, min(start + size, end))
+        for first, end in ranges
+        for start in range(first, end, size)
+    )
+    done = 0
+    started = time.monotonic()
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=initargs
+    ) as pool:
+
+        def submit(chunk):
+            return pool.submit(_render, *chunk)
+
+        for (start, end), future in osr.windowed(submit, chunks, window):
+            result = future.result()
+            if sink.ordered:
+                for frame, data in enumerate(result, start):
+                    sink.write(frame, data)
+            done += end - start
+            fps = done / (time.monotonic() - started)
+            sys.stderr.write("%5d - %5.0f fps - %.4f\r" % (done, fps, done / frames))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="osu! replay visualizer")
+    parser.add_argument("path", help="folder containing replays and mp3")
+    parser.add_argument("-t", "--tail", help="tail length", type=int, default=100)
+    parser.add_argument("-r", "--radius", help="circle radius", type=int, default=5)
+    parser.add_argument(
+        "-w",
+        "--no-wipe",
+        help="don't wipe the screen each frame",
+        dest="wipe",
+        action="store_false",
+    )
+    parser.add_argument(
+        "-f", "--no-flip", help="don't flip hr plays", dest="flip", action="store_false"
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="don't use the decoded replay cache",
+        dest="cache",
+        action="store_false",
+    )
+    parser.add_argument("--width", help="image width", type=int, default=WIDTH)
+    parser.add_argument("--height", help="image height", type=int, default=HEIGHT)
+    parser.add_argument("--fps", help="frames per second", type=float, default=FPS)
+    parser.add_argument(
+        "--preview",
+        help="a quick look: smaller, fewer frames and no key boxes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--preview-scale",
+        help="--preview at 1/N the size and fps (default 4)",
+        type=int,
+        default=4,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--backend",
+        help="how frames are drawn (default pil)",
+        choices=raster.BACKENDS,
+        default="pil",
+    )
+    parser.add_argument(
+        "-j", "--workers", help="render frames in N processes", type=int, default=1
+    )
+    parser.add_argument(
+        "--start-frame", help="first frame to render", type=int, default=0
+    )
+    parser.add_argument(
+        "--end-frame", help="render up to but not including this frame", type=int
+    )
+    parser.add_argument(
+        "--resume",
+        help="skip frames the output folder's manifest says are already done",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--threads",
+        help="encode and write frames on N threads (default 2)",
+        type=int,
+        default=2,
+    )
+    frame_sinks.add_arguments(parser)
+    replay_index.add_arguments(parser)
+    args = parser.parse_args()
+
+    pathname = args.path
+    tail = args.tail
+    radius = args.radius
+    # the check has always been the wrong way round: frames are only wiped
+    # with --no-wipe
+    wipe = not args.wipe
+    flip = args.flip
+    size = (args.width, args.height)
+    fps = args.fps
+    if args.preview:
+        scale = args.preview_scale
+        if scale < 1:
+            parser.error("--preview-scale must be at least 1")
+        size = (args.width // scale, args.height // scale)
+        fps = args.fps / scale
+        radius = max(1, round(radius / scale))
+    cache = replay_cache.ReplayCache() if args.cache else None
+
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.workers > 1 and not wipe:
+        # without wiping every frame is drawn over all the ones before it
+        parser.error("--workers only works with --no-wipe")
+    if (args.start_frame or args.resume) and not wipe:
+        parser.error("--start-frame and --resume only work with --no-wipe")
+    if args.resume and args.format not in ("tga", "png"):
+        parser.error("--resume only works with tga and png frames")
+
+    basename = os.path.basename(pathname)
+    # keep stdout clean when the video is written to it
+    stdout = args.format in ("raw", "y4m") and args.output in (None, "-")
+    log = sys.stderr if stdout else None
+
+    if args.top or args.beatmap or args.mods:
+        files = replay_index.select_files(args, pathname, recursive=False)
+    else:
+        files = glob.glob(os.path.join(pathname, "*.osr"))
+    if len(files) == 0:
+        sys.exit("no replays to read")
+
+    replays = []
+
+    for name, replay, error in osr.read_many(files, flip, cache=cache):
+        if error:
+            sys.stderr.write("%s: %s\n" % (name, error))
+        else:
+            replays.append(replay)
+
+    if len(replays) == 0:
+        sys.exit("no replays to read")
+
+    replays.sort()
+
+    n = len(replays)
+    for r in replays:
+        print("%2d. %15s - %d" % (n, r.player, r.score), file=log)
+        n -= 1
+    print("read %d replays" % len(replays), file=log)
+
+    for replay in replays:
+        # the same on every run, so separate runs can render parts of a video
+        rng = random.Random(replay.replay_hash)
+        replay.color = WHITE if len(replays) == 1 else pick_color(rng)
+
+    renderer = Renderer(
+        replays,
+        basename,
+        tail,
+        radius,
+        wipe,
+        args.backend,
+        size,
+        fps,
+        keys=not args.preview,
+    )
+    frames = renderer.frames
+
+    mins, secs = divmod(int(frames / fps), 60)
+    print(f"{frames} frames total -> {mins}m{secs:2d}s", file=log)
+
+    start = args.start_frame
+    end = frames if args.end_frame is None else min(args.end_frame, frames)
+
+    with frame_sinks.open_sink(args, basename, *size, fps) as sink:
+        done = set()
+        if isinstance(sink, frame_sinks.ImageSequence):
+            settings = {
+                "replays": [replay.replay_hash for replay in replays],
+                "size": size,
+                "fps": fps,
+                "keys": renderer.keys,
+                "tail": tail,
+                "radius": radius,
+                "flip": flip,
+                "backend": args.backend,
+                "format": args.format,
+                "params": sink.params,
+            }
+            try:
+                done = sink.manifest.start(settings, args.resume)
+            except ValueError as e:
+                sys.exit("%s, can't resume" % e)
+            if done:
+                print("%d frames already done" % len(done), file=log)
+        ranges = runs(frame for frame in range(start, end) if frame not in done)
+        if args.workers > 1:
+            render_parallel(renderer, sink, args.workers, ranges)
+        else:
+            renderer.render(ranges, sink, progress=True, threads=args.threads)
+
+
+if __name__ == "__main__":
+    main()
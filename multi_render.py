@@ -1,183 +1,496 @@
 import argparse
+import math
+import queue
 import random
 import sys
-from collections import deque
+import threading
+import time
 from glob import glob
 from os.path import join
 
+import numpy as np
 import pygame
 import pygame.gfxdraw
-from recordclass import recordclass
 
 import osr
+import playfield
+import replay_cache
+import replay_index
+from playfield import Playfield
+from timeline import Timeline
 
 BLACK = (0, 0, 0)
 GRAY = (100, 100, 100)
 WHITE = (255, 255, 255)
 
+PREMULTIPLIED = pygame.BLEND_PREMULTIPLIED
+
+HEIGHT = 768
+WIDTH = 1366
+
+# playback speeds the up and down arrows step through
+SPEEDS = (0.25, 0.5, 0.75, 1, 1.5, 2)
+# how far the left and right arrows seek, in ms
+SEEK = 5000
+# the height of the seek bar, and of the strip along the bottom that grabs it
+BAR_HEIGHT = 4
+BAR_GRAB = 16
+# the music's position only moves when a buffer is mixed, so playback follows
+# a timer instead, making up this much of the difference every time it moves
+# and jumping straight to it if they're further apart than RESYNC ms
+DRIFT_GAIN = 0.1
+RESYNC = 100
+
 
 def pick_color():
     return tuple(random.randrange(64, 256) for i in range(3))
 
 
-def quit():
+def cursor_sprite(color, radius):
+    """A cursor as drawn by gfxdraw, with premultiplied alpha.
+
+    It's drawn over black and over white, which between them give the color
+    and coverage of each pixel. Blit it with BLEND_PREMULTIPLIED so that its
+    center, (radius + 1, radius + 1), lands where the circle would be drawn.
+    """
+    size = 2 * radius + 3
+    layers = []
+    for background in (BLACK, WHITE):
+        surface = pygame.Surface((size, size))
+        surface.fill(background)
+        pygame.gfxdraw.filled_circle(surface, radius + 1, radius + 1, radius, color)
+        pygame.gfxdraw.aacircle(surface, radius + 1, radius + 1, radius, BLACK)
+        layers.append(pygame.surfarray.array3d(surface).astype(int))
+    over_black, over_white = layers
+    sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+    pygame.surfarray.pixels3d(sprite)[:] = over_black
+    pygame.surfarray.pixels_alpha(sprite)[:] = 255 - (over_white - over_black).max(2)
+    return sprite
+
+
+class Playback:
+    """The playback position in ms, kept in sync with the music.
+
+    At normal speed the music is restarted from the right place on every
+    seek, and the position follows a timer that's steered toward the
+    music's position whenever it moves. At other speeds, or while paused,
+    the music is stopped and the timer alone is used instead, since pygame
+    can't play it faster or slower.
+    """
+
+    def __init__(self, end):
+        self.end = end
+        self.speed = 1
+        self.paused = False
+        self._start(0)
+
+    def _start(self, pos):
+        self.origin = pos
+        self.started = time.perf_counter()
+        self._music = None
+        self._last = pos
+        if self.speed == 1 and not self.paused:
+            pygame.mixer.music.play(start=pos / 1000)
+        else:
+            pygame.mixer.music.pause()
+
+    @property
+    def pos(self):
+        if self.paused:
+            return self.origin
+        pos = self.origin + (time.perf_counter() - self.started) * 1000 * self.speed
+        if self.speed == 1:
+            music = pygame.mixer.music.get_pos()
+            if music >= 0 and music != self._music:
+                self._music = music
+                error = self.origin + music - pos
+                if abs(error) < RESYNC:
+                    error *= DRIFT_GAIN
+                self.started -= error / 1000
+                pos += error
+        # steering back shouldn't make the cursors go backwards
+        self._last = max(pos, self._last)
+        return self._last
+
+    @property
+    def done(self):
+        """Whether the music or, when it isn't playing, the replays are over."""
+        if self.paused:
+            return False
+        if self.speed == 1:
+            return not pygame.mixer.music.get_busy()
+        return self.pos >= self.end
+
+    def seek(self, pos):
+        self._start(min(max(pos, 0), self.end))
+
+    def set_speed(self, speed):
+        pos = self.pos
+        self.speed = speed
+        self._start(pos)
+
+    def set_paused(self, paused):
+        pos = self.pos
+        self.paused = paused
+        self._start(pos)
+
+
+def set_caption(radius, tail, playback):
+    pygame.display.set_caption(
+        "radius=%d tail=%d speed=%gx%s"
+        % (radius, tail, playback.speed, " (paused)" if playback.paused else "")
+    )
+
+
+class Loader:
+    """Reads replays on a background thread, handing them over as they're done."""
+
+    def __init__(self, files, flip, cache):
+        self.total = len(files)
+        self.read = 0
+        self.done = False
+        self._results = queue.Queue()
+        self._stop = threading.Event()
+        thread = threading.Thread(
+            target=self._load, args=(files, flip, cache), daemon=True
+        )
+        thread.start()
+
+    def _load(self, files, flip, cache):
+        results = osr.read_many(files, flip, ordered=False, cache=cache)
+        try:
+            for result in results:
+                self._results.put(result)
+                if self._stop.is_set():
+                    break
+        finally:
+            # cancels the files that haven't been read yet
+            results.close()
+            self._results.put(None)
+
+    def poll(self):
+        """The replays read since the last call."""
+        replays = []
+        while not self.done:
+            try:
+                result = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if result is None:
+                self.done = True
+            elif result.error:
+                self.read += 1
+                sys.stderr.write("%s: %s\n" % (result.path, result.error))
+            else:
+                self.read += 1
+                replays.append(result.replay)
+        return replays
+
+    def stop(self):
+        self._stop.set()
+
+
+def draw_loading(screen, font, loader):
+    text = "loading replays %d/%d" % (loader.read, loader.total)
+    screen.blit(font.render(text, True, WHITE, BLACK), (10, 10))
+
+
+def quit(loader):
     print("\n")
+    loader.stop()
     pygame.quit()
     sys.exit(42)
 
 
-parser = argparse.ArgumentParser(description="osu! replay visualizer")
-parser.add_argument("path", help="folder containing replays and mp3")
-parser.add_argument("-t", "--tail", help="tail length", type=int, default=100)
-parser.add_argument("-r", "--radius", help="circle radius", type=int, default=5)
-parser.add_argument(
-    "-w",
-    "--no-wipe",
-    help="don't wipe the screen each frame",
-    dest="wipe",
-    action="store_false",
-)
-parser.add_argument(
-    "-f", "--no-flip", help="don't flip hr plays", dest="flip", action="store_false"
-)
-args = parser.parse_args()
-
-pathname = args.path
-tail = args.tail
-radius = args.radius
-wipe = args.wipe
-flip = args.flip
-
-files = glob(join(pathname, "**/*.osr"), recursive=True)
-if len(files) == 0:
-    sys.exit("no replays to read")
-
-replays = []
-
-for name in files:
-    replay = osr.read_file(name, flip)
-    replays.append(replay)
-
-replays.sort()
-
-n = len(replays)
-for r in replays:
-    print("%2d. %15s - %d" % (n, r.player, r.score))
-    n -= 1
-print("read %d replays" % len(replays))
-
-State = recordclass("State", "replay color x y z trail")
-states = []
-
-for replay in replays:
-    # we don't need anything else on the replay object so remove the references
-    replay = replay.replay
-    color = WHITE if len(replays) == 1 else pick_color()
-    states.append(State(replay, color, 0, 0, 0, deque()))
-
-del replays
+def main():
+    parser = argparse.ArgumentParser(description="osu! replay visualizer")
+    parser.add_argument("path", help="folder containing replays and mp3")
+    parser.add_argument("-t", "--tail", help="tail length", type=int, default=100)
+    parser.add_argument("-r", "--radius", help="circle radius", type=int, default=5)
+    parser.add_argument(
+        "-w",
+        "--no-wipe",
+        help="don't wipe the screen each frame",
+        dest="wipe",
+        action="store_false",
+    )
+    parser.add_argument(
+        "-f", "--no-flip", help="don't flip hr plays", dest="flip", action="store_false"
+    )
+    parser.add_argument(
+        "--no-cache",
+        help="don't use the decoded replay cache",
+        dest="cache",
+        action="store_false",
+    )
+    parser.add_argument("--width", help="window width", type=int, default=WIDTH)
+    parser.add_argument("--height", help="window height", type=int, default=HEIGHT)
+    parser.add_argument(
+        "--fps",
+        help="how often cursor positions are sampled (default 120)",
+        type=int,
+        default=120,
+    )
+    parser.add_argument(
+        "--max-fps",
+        help="most frames to draw a second (default --fps, 0 for no limit)",
+        type=int,
+    )
+    parser.add_argument(
+        "--vsync", help="wait for the display to refresh", action="store_true"
+    )
+    replay_index.add_arguments(parser)
+    args = parser.parse_args()
+
+    pathname = args.path
+    tail = args.tail
+    radius = args.radius
+    wipe = args.wipe
+    flip = args.flip
+    max_fps = args.fps if args.max_fps is None else args.max_fps
+    cache = replay_cache.ReplayCache() if args.cache else None
+
+    if args.top or args.beatmap or args.mods:
+        files = replay_index.select_files(args, pathname, recursive=True)
+    else:
+        files = glob(join(pathname, "**/*.osr"), recursive=True)
+    if len(files) == 0:
+        sys.exit("no replays to read")
+
+    loader = Loader(files, flip, cache)
+    timeline = Timeline([], args.fps)
+    width, height = args.width, args.height
+    # the playfield where the osu! client puts it, for easy overlay on video
+    scale = Playfield.client(width, height)
+    # every replay's cursor positions scaled to the screen, in the order they
+    # were read, which is the timeline's
+    scaled = []
+    colors = []
+    previous = []
+    # the replays' timeline columns from the lowest score to the highest, and
+    # where each column comes in that order, which is its row on the key panel
+    order = []
+    rank = []
+    # keys last drawn on the key panel, None to draw them
+    held = []
+
+    pygame.mixer.pre_init(44100)
+    pygame.init()
+    screen = None
+    if args.vsync:
+        try:
+            # vsync only works with a scaled or OpenGL window
+            screen = pygame.display.set_mode((width, height), pygame.SCALED, vsync=1)
+        except pygame.error as e:
+            sys.stderr.write("no vsync: %s\n" % e)
+    if screen is None:
+        screen = pygame.display.set_mode((width, height))
+    pygame.mixer.music.load(*glob(join(pathname, "*.mp3")))
+    pygame.mixer.music.set_volume(0.5)
+    playback = Playback(0)
+    set_caption(radius, tail, playback)
+    clock = pygame.time.Clock()
+
+    font = pygame.font.Font(None, 24)
+
+    # every replay's cursor, drawn again only when the radius changes
+    sprites = []
+    sprite_radius = radius
+    # the key boxes, drawn again only for replays whose keys changed
+    panel = None
+    # whether the seek bar is being dragged, and if playback was paused before
+    scrubbing = False
+    was_paused = False
+    # the timeline frame on screen, which is only drawn again if it changes
+    drawn = None
+    # whether the ranking has been printed, once every replay is read
+    ranked = False
+
+    UPDATE_FPS = pygame.USEREVENT
+    pygame.time.set_timer(UPDATE_FPS, 100)
+
+    screen.fill(BLACK)
+
+    while not playback.done or not loader.done:
+        seeked = False
+        # the loading progress is redrawn every frame until it's done
+        changed = not loader.done
+
+        replays = loader.poll()
+        if replays:
+            # the new replays join in as if everything had just been seeked to
+            seeked = True
+            timeline.extend(replays)
+            playback.end = len(timeline) * timeline.interval
+            for replay in replays:
+                x, y = scale(replay.x.astype(float), replay.y.astype(float))
+                scaled.append(np.column_stack((x, y)))
+                colors.append(WHITE if loader.total == 1 else pick_color())
+                sprites.append(cursor_sprite(colors[-1], sprite_radius))
+            order = sorted(range(len(scaled)), key=timeline.replays.__getitem__)
+            rank = [0] * len(order)
+            for r, i in enumerate(order):
+                rank[i] = r
+            # the boxes get smaller and move down as replays join
+            keysize = playfield.keysize(width, height, len(scaled))
+            panel_left = width - keysize * 5
+            panel = pygame.Surface(
+                (math.ceil(keysize * 5), math.ceil(keysize * len(scaled)))
+            )
+            held = [None] * len(scaled)
+        if loader.done and not ranked:
+            ranked = True
+            if not scaled:
+                pygame.quit()
+                sys.exit("no replays to read")
+            n = len(order)
+            for i in order:
+                replay = timeline.replays[i]
+                print("%2d. %15s - %d" % (n, replay.player, replay.score))
+                n -= 1
+            print("read %d replays" % len(order))
+
+        for event in pygame.event.get():
+            if event.type != UPDATE_FPS:
+                changed = True
+            if event.type == pygame.QUIT:
+                quit(loader)
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    quit(loader)
+                elif event.mod & pygame.KMOD_CTRL and event.key == pygame.K_c:
+                    quit(loader)
+                elif event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                    step = SEEK if event.key == pygame.K_RIGHT else -SEEK
+                    playback.seek(playback.pos + step)
+                    seeked = True
+                elif event.key in (pygame.K_UP, pygame.K_DOWN):
+                    i = SPEEDS.index(playback.speed)
+                    i += 1 if event.key == pygame.K_UP else -1
+                    playback.set_speed(SPEEDS[min(max(i, 0), len(SPEEDS) - 1)])
+                elif event.key == pygame.K_SPACE:
+                    playback.set_paused(not playback.paused)
+                set_caption(radius, tail, playback)
+
+            elif event.type == pygame.MOUSEBUTTONDOWN:
+                if event.button == 1 and event.pos[1] >= height - BAR_GRAB:
+                    scrubbing = True
+                    was_paused = playback.paused
+                    playback.set_paused(True)
+                    playback.seek(event.pos[0] / width * playback.end)
+                    seeked = True
+                elif event.button == 1:  # left mouse button
+                    radius += 1
+                elif event.button == 3:  # right mouse button
+                    radius = max(0, radius - 1)
+                elif event.button == 4:  # scroll up
+                    tail += 10
+                elif event.button == 5:  # scroll down
+                    tail = max(0, tail - 10)
+                if event.button == 2:  # middle mouse button
+                    wipe = not wipe
+                set_caption(radius, tail, playback)
+
+            elif event.type == pygame.MOUSEMOTION and scrubbing:
+                playback.seek(event.pos[0] / width * playback.end)
+                seeked = True
+
+            elif event.type == pygame.MOUSEBUTTONUP and scrubbing:
+                if event.button == 1:
+                    scrubbing = False
+                    playback.set_paused(was_paused)
+
+            elif event.type == UPDATE_FPS:
+                sys.stderr.write("%5.0f fps\r" % clock.get_fps())
+
+        clock.tick(max_fps)
+        if not len(timeline):
+            # nothing read yet, or only replays without any frames, so there's
+            # no frame to show and playback.end is still 0
+            screen.fill(BLACK)
+            if not loader.done:
+                draw_loading(screen, font, loader)
+            pygame.display.flip()
+            continue
+        # the last timeline frame at or before the playback position
+        pos = playback.pos
+        frame = timeline.frame_at(pos)
+        row = min(max(frame, 0), len(timeline) - 1)
+        if row == drawn and not changed:
+            if not max_fps:
+                # nothing new to draw, and tick() didn't wait
+                time.sleep(0.001)
+            continue
+        drawn = row
+        if seeked:
+            # only what's current at the new position, not everything between
+            previous = timeline.previous(row).tolist()
+            if not wipe:
+                screen.fill(BLACK)
+        index = timeline.index[row].tolist()
+        trail_start = timeline.trail_start(tail, slice(row, row + 1))[0].tolist()
+        xs, ys = scale(timeline.x[row].astype(float), timeline.y[row].astype(float))
+        cursors = list(zip(xs.tolist(), ys.tolist()))
+        masks = timeline.keys[row].tolist()
+        if wipe:
+            screen.fill(BLACK)
+        if radius != sprite_radius:
+            sprites = [cursor_sprite(color, radius) for color in colors]
+            sprite_radius = radius
+        offset = radius + 1
+
+        lines = []
+        circles = []
+
+        for i in order:
+            p = scaled[i]
+            sprite = sprites[i]
+            # the replay frames that became current since the last frame, the
+            # last of which is where the cursor is
+            a, b = previous[i] + 1, index[i] + 1
+            if a < b:
+                circles.extend(
+                    (sprite, (int(x) - offset, int(y) - offset), None, PREMULTIPLIED)
+                    for x, y in p[a:b].tolist()
+                )
+            else:
+                x, y = cursors[i]
+                circles.append(
+                    (sprite, (int(x) - offset, int(y) - offset), None, PREMULTIPLIED)
+                )
+            if b - trail_start[i] > 1:
+                lines.append((p[trail_start[i] : b].tolist(), colors[i]))
+            if masks[i] != held[i]:
+                y = rank[i] * keysize
+                for j, key in enumerate(osr.KEYS):
+                    rect = (j * keysize, y, keysize, keysize)
+                    pygame.draw.rect(
+                        panel, colors[i] if masks[i] & key else BLACK, rect
+                    )
+                held[i] = masks[i]
+        previous = index
+
+        if tail:
+            for points, color in lines:
+                pygame.draw.lines(screen, color, False, points)
+
+        if radius:
+            screen.blits(circles, False)
+
+        screen.blit(panel, (panel_left, 0))
+
+        bar = pygame.Rect(0, height - BAR_HEIGHT, width, BAR_HEIGHT)
+        screen.fill(GRAY, bar)
+        bar.width = min(pos / playback.end, 1) * width
+        screen.fill(WHITE, bar)
+
+        if not loader.done:
+            draw_loading(screen, font, loader)
+
+        pygame.display.flip()
 
-HEIGHT = 768
-WIDTH = 1366
-KEYSIZE = min((WIDTH - 1024) / 5, HEIGHT / len(states))
-
-# This centers the play on the window just like in osu! client, which helps with
-# easy overlay for video. It only works for 1366x768 though
-X_CHANGE = 273
-Y_CHANGE = 89
-SCALE = 1.551
-
-
-def scale(x, y):
-    return (x + X_CHANGE / SCALE) * SCALE, (y + Y_CHANGE / SCALE) * SCALE
-
-
-pygame.mixer.pre_init(44100)
-pygame.init()
-screen = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("radius=%d tail=%d" % (radius, tail))
-pygame.mixer.music.load(*glob(join(pathname, "*.mp3")))
-pygame.mixer.music.play()
-pygame.mixer.music.set_volume(0.5)
-clock = pygame.time.Clock()
-
-UPDATE_FPS = pygame.USEREVENT
-pygame.time.set_timer(UPDATE_FPS, 100)
-
-last_pos = 0
-
-screen.fill(BLACK)
-
-while pygame.mixer.music.get_busy():
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            quit()
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
-                quit()
-            elif event.mod & pygame.KMOD_CTRL and event.key == pygame.K_c:
-                quit()
-
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            if event.button == 1:  # left mouse button
-                radius += 1
-            elif event.button == 3:  # right mouse button
-                radius = max(0, radius - 1)
-            elif event.button == 4:  # scroll up
-                tail += 10
-            elif event.button == 5:  # scroll down
-                tail = max(0, tail - 10)
-            if event.button == 2:  # middle mouse button
-                wipe = not wipe
-            pygame.display.set_caption("radius=%d tail=%d" % (radius, tail))
-
-        elif event.type == UPDATE_FPS:
-            sys.stderr.write("%5.0f fps\r" % clock.get_fps())
-
-    clock.tick()
-    pos = pygame.mixer.music.get_pos()
-    if wipe:
-        screen.fill(BLACK)
-
-    lines = []
-    circles = []
-    rects = []
-
-    for i, state in enumerate(states):
-        r = state.replay
-        trail = state.trail
-        color = state.color
-        while r and r[0].t <= pos:
-            p = r.popleft()
-            state.x, state.y, state.z = p.x, p.y, p.z
-            circles.append((scale(state.x, state.y), color))
-            trail.append(p)
-        o = (scale(state.x, state.y), color)
-        if o not in circles:
-            circles.append(o)
-        while trail and (pos - trail[0].t) > tail:
-            trail.popleft()
-        if len(trail) > 1:
-            points = [scale(p.x, p.y) for p in trail]
-            lines.append((points, color))
-        y = i * KEYSIZE
-        for j, o in enumerate(osr.keys(state.z)):
-            x = WIDTH - KEYSIZE * 5 + j * KEYSIZE
-            rects.append(((x, y, KEYSIZE, KEYSIZE), color if o else BLACK))
-
-    if tail:
-        for points, color in lines:
-            pygame.draw.lines(screen, color, False, points)
-
-    if radius:
-        for (x, y), color in circles:
-            x, y = int(x), int(y)
-            pygame.gfxdraw.filled_circle(screen, x, y, radius, color)
-            pygame.gfxdraw.aacircle(screen, x, y, radius, BLACK)
-
-    for rect, color in rects:
-        pygame.draw.rect(screen, color, rect)
-
-    pygame.display.flip()
-
-pygame.quit()
+    pygame.quit()
+
+
+if __name__ == "__main__":
+    main()
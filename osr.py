@@ -1,6 +1,14 @@
+import io
 import lzma
+import mmap
+import os
 import struct
 from collections import deque, namedtuple
+from concurrent import futures
+from glob import glob
+from itertools import islice
+
+import numpy as np
 
 MODES = ["osu!", "Taiko", "Catch the Beat", "osu!mania"]
 SHORTMODS = [
@@ -80,26 +88,83 @@ def shortmods(n):
     return s
 
 
-def parse_uleb128(f):
+def parse_mods(s):
+    """The mod bits for a string of short mod names like "HDHR"."""
+    n = 0
+    for i in range(0, len(s), 2):
+        try:
+            n |= 1 << (SHORTMODS.index(s[i : i + 2].upper()) - 1)
+        except ValueError:
+            raise ValueError("unknown mod %r" % s[i : i + 2]) from None
+    return n
+
+
+def parse_uleb128(buf, offset=0):
+    """Parse a uleb128 at offset in buf, returning it and the offset after it."""
     result = 0
     shift = 0
     while True:
-        byte = struct.unpack("<B", f.read(1))[0]
+        byte = buf[offset]
+        offset += 1
         result |= (byte & 0x7F) << shift
         if (byte & 0x80) == 0:
             break
         shift += 7
 
-    return result
+    return result, offset
 
 
-def parse_string(f):
-    head = struct.unpack("<B", f.read(1))[0]
+def parse_string(buf, offset=0):
+    """Parse a string at offset in buf, returning it and the offset after it."""
+    head = buf[offset]
+    offset += 1
     if head == 0x00:
-        return ""
+        return "", offset
     elif head == 0x0B:
-        length = parse_uleb128(f)
-        return f.read(length).decode()
+        length, offset = parse_uleb128(buf, offset)
+        return bytes(buf[offset : offset + length]).decode(), offset + length
+    raise ValueError("bad string marker %#x at offset %d" % (head, offset - 1))
+
+
+def encode_uleb128(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def encode_string(s):
+    if not s:
+        return b"\x00"
+    data = s.encode()
+    return b"\x0b" + encode_uleb128(len(data)) + data
+
+
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+def _map(f):
+    """Memory map an open file and return the map and f's position in it.
+
+    Returns None for file objects that can't be mapped, like pipes.
+    """
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _buffer(f):
+    """Return the contents of an open file and where f's position is in them.
+
+    Real files are memory mapped so nothing is copied until it's used.
+    """
+    return _map(f) or (f.read(), 0)
 
 
 def each_bit(n, count):
@@ -117,7 +182,247 @@ def keys(z):
     yield z & 16 == 16
 
 
+# The bits of a key mask, one per key in the order keys yields them. In z, K1
+# and K2 come with M1 and M2 set too, so they can't be told apart bit by bit.
+K1 = 1
+K2 = 2
+M1 = 4
+M2 = 8
+SMOKE = 16
+KEYS = (K1, K2, M1, M2, SMOKE)
+KEY_NAMES = ("K1", "K2", "M1", "M2", "SMOKE")
+
+
+def key_mask(z):
+    """The keys held in z as K1 to SMOKE bits, for a whole array of z at once."""
+    z = np.asarray(z)
+    mask = (z & 5 == 5) * K1 | (z & 10 == 10) * K2
+    mask |= (z & 5 == 1) * M1 | (z & 10 == 2) * M2 | (z & 16 == 16) * SMOKE
+    return mask.astype(np.uint8)
+
+
+def key_edges(mask):
+    """The keys pressed and released at each frame of an array of key masks.
+
+    Returns two masks per frame: the keys down that weren't at the frame
+    before, and the keys that were but aren't any more. Keys down at the
+    first frame count as pressed there.
+    """
+    mask = np.asarray(mask)
+    before = np.concatenate([np.zeros(1, mask.dtype), mask[:-1]])
+    return mask & ~before, before & ~mask
+
+
 ReplayPoint = namedtuple("ReplayPoint", "t x y z")
+# a run of consecutive frames, one array per column
+Frames = namedtuple("Frames", "t x y z")
+
+HEADER_FIELDS = (
+    "mode",
+    "version",
+    "beatmap_hash",
+    "player",
+    "replay_hash",
+    "n300",
+    "n100",
+    "n50",
+    "ngeki",
+    "nkatu",
+    "nmiss",
+    "score",
+    "combo",
+    "perfect",
+    "mods",
+    "life_events",
+    "timestamp",
+    "length",
+)
+FRAME_FIELDS = ("t", "x", "y", "z", "seed")
+
+# mode and version, then the hit counts, score, combo, perfect flag and mods,
+# then the timestamp and compressed frame length, and the online score id that
+# follows the frames
+HEAD = struct.Struct("<BI")
+SCORE = struct.Struct("<HHHHHHIH?I")
+TAIL = struct.Struct("<QI")
+SCORE_ID = struct.Struct("<q")
+# the first version whose replays have the online score id
+SCORE_ID_VERSION = 20140721
+
+# w of the trailing record that stores the replay's rng seed in its z
+SEED_W = -12345
+
+
+def decode_frames(data, flip=False):
+    """Decode the decompressed "w|x|y|z," frame text in bulk.
+
+    Returns the t, x, y and z columns plus the rng seed (or None) exactly as
+    reading the records one at a time and accumulating t += w would.
+    """
+    data = data.strip(",")
+    # joining the fields would hide records with the wrong number of them, so
+    # check that each record ends 3 "|" after the one before it
+    text = np.frombuffer(data.encode(), np.uint8)
+    pipes = np.cumsum(text == ord("|"))
+    ends = np.append(pipes[text == ord(",")], pipes[-1:])
+    if (np.diff(ends, prepend=0) != 3).any():
+        raise ValueError("malformed frame data")
+    values = np.fromstring(data.replace("|", ","), sep=",")
+    if len(values) != 4 * len(ends):
+        raise ValueError("malformed frame data")
+    w, x, y, z = values.reshape(-1, 4).T
+    w = w.astype(np.int64)
+    z = z.astype(np.int64)
+    seed = None
+    is_seed = w == SEED_W
+    if is_seed.any():
+        # the last record carries the rng seed instead of key state
+        seed = int(z[is_seed][-1])
+        z[is_seed] = 0
+    return (
+        np.cumsum(w),
+        x.astype(np.float32),
+        flip_y(y) if flip else y.astype(np.float32),
+        z.astype(np.uint8),
+        seed,
+    )
+
+
+def flip_y(y):
+    """Mirror a y column vertically, as HR does to the playfield.
+
+    Returns float32. Frames are flipped as the float64 values parsed from
+    the text, before they're rounded to float32. A float32 column is first
+    turned back into those through the shortest decimal that rounds to each
+    value, which is how replays and encode_frames write them, so flipping a
+    stored column gives the same bits as decoding with flip on. Flipping
+    the float32 values directly would be up to a float32 step of 384 off.
+    """
+    if y.dtype == np.float32:
+        y = y.astype(str).astype(np.float64)
+    return (384 - y).astype(np.float32)
+
+
+def encode_frames(t, x, y, z, seed=None):
+    """Encode frame columns back into "w|x|y|z," text.
+
+    This is the inverse of decode_frames; if seed is given the last frame is
+    the seed record.
+    """
+    w = np.diff(t, prepend=0)
+    z = z.astype(np.int64)
+    if seed is not None:
+        z[-1] = seed
+    columns = [column.astype(str) for column in (w, x, y, z)]
+    return "".join("%s|%s|%s|%s," % rec for rec in zip(*columns))
+
+
+def _read_header(f, r, block):
+    """Read r's header from a file object that can't be mapped.
+
+    f is read a block at a time until the header parses; returns the payload
+    bytes that were read along with it.
+    """
+    head = b""
+    while True:
+        data = f.read(block)
+        head += data
+        try:
+            offset = r.read_header(head)
+        except (IndexError, ValueError, struct.error):
+            # most likely cut off mid header, unless there's nothing left
+            if not data:
+                raise
+            continue
+        return head[offset:]
+
+
+def _read_payload(f, head, length, block):
+    """Yield the length payload bytes of a replay, head first, then f's."""
+    head = head[:length]
+    for offset in range(0, len(head), block):
+        yield head[offset : offset + block]
+    length -= len(head)
+    while length > 0:
+        data = f.read(min(block, length))
+        if not data:
+            return
+        length -= len(data)
+        yield data
+
+
+def _decode_stream(chunks, flip, block):
+    decompressor = lzma.LZMADecompressor()
+    chunks = iter(chunks)
+    tail = ""
+    t = 0
+    while not decompressor.eof:
+        data = b""
+        if decompressor.needs_input:
+            data = next(chunks, b"")
+            if not data:
+                raise EOFError("replay data ended before the end of the lzma stream")
+        text = tail + decompressor.decompress(data, block).decode()
+        if decompressor.eof:
+            tail = ""
+        else:
+            # keep the record that got cut off for the next block
+            text, _, tail = text.rpartition(",")
+        ts, x, y, z, _ = decode_frames(text, flip)
+        if len(ts):
+            ts += t
+            t = ts[-1]
+            yield Frames(ts, x, y, z)
+
+
+def iter_frames(f, flip_hr=False, chunk=None, block=1 << 16):
+    """Decode the frames of a replay while decompressing it.
+
+    f is a path, a file object at the start of an .osr file or a buffer
+    holding one. Frames are
+    yielded one ReplayPoint at a time or, given chunk, as Frames of chunk
+    frames each (the last one may be shorter). Only about block bytes of
+    compressed and decompressed data are held at once; files that can't be
+    memory mapped, like pipes, are read a block at a time. If the data turns out
+    to be truncated or corrupt, every frame before the damage is yielded
+    before the error is raised.
+    """
+    if isinstance(f, (str, os.PathLike)):
+        with open(f, "rb") as ff:
+            yield from iter_frames(ff, flip_hr, chunk, block)
+        return
+    mapped = (f, 0) if isinstance(f, BUFFER_TYPES) else _map(f)
+    r = Replay()
+    if mapped is None:
+        head = _read_header(f, r, block)
+        payload = _read_payload(f, head, r.length, block)
+    else:
+        buf, offset = mapped
+        offset = r.read_header(buf, offset)
+        view = memoryview(buf)[offset : offset + r.length]
+        payload = (view[i : i + block] for i in range(0, len(view), block))
+    blocks = _decode_stream(payload, flip_hr and r.has_mod(16), block)
+    if chunk is None:
+        for frames in blocks:
+            yield from map(ReplayPoint, *(column.tolist() for column in frames))
+        return
+    pending = []
+    count = 0
+    try:
+        for frames in blocks:
+            pending.append(frames)
+            count += len(frames.t)
+            while count >= chunk:
+                frames = Frames(*map(np.concatenate, zip(*pending)))
+                yield Frames(*(column[:chunk] for column in frames))
+                pending = [Frames(*(column[chunk:] for column in frames))]
+                count -= chunk
+    except (lzma.LZMAError, EOFError):
+        if count:
+            yield Frames(*map(np.concatenate, zip(*pending)))
+        raise
+    if count:
+        yield Frames(*map(np.concatenate, zip(*pending)))
 
 
 class Replay:
@@ -140,16 +445,31 @@ class Replay:
         "life_events",
         "timestamp",
         "length",
-        "replay",
+        "path",
+        "offset",
+        "_payload",
+        "_flip",
+        "t",
+        "x",
+        "y",
+        "z",
+        "seed",
+        "_index",
+        "_keys",
         "color",
     ]
 
-    def read_file(self, f, flip_hr=False):
-        self.mode, self.version = struct.unpack("<BI", f.read(5))
+    def read_header(self, buf, offset=0):
+        """Parse everything up to the compressed frames at offset in buf.
+
+        Returns the offset of the compressed frames.
+        """
+        self.mode, self.version = HEAD.unpack_from(buf, offset)
         assert self.mode == 0, "%s support not added yet" % MODES[self.mode]
-        self.beatmap_hash = parse_string(f)
-        self.player = parse_string(f)
-        self.replay_hash = parse_string(f)
+        offset += HEAD.size
+        self.beatmap_hash, offset = parse_string(buf, offset)
+        self.player, offset = parse_string(buf, offset)
+        self.replay_hash, offset = parse_string(buf, offset)
         (
             self.n300,
             self.n100,
@@ -161,36 +481,218 @@ class Replay:
             self.combo,
             self.perfect,
             self.mods,
-        ) = struct.unpack("<HHHHHHIH?I", f.read(23))
+        ) = SCORE.unpack_from(buf, offset)
+        offset += SCORE.size
+        life_bar, offset = parse_string(buf, offset)
         self.life_events = deque()
-        for rec in parse_string(f).split(","):
+        for rec in life_bar.split(","):
             if rec:
                 u, v = rec.split("|")
                 self.life_events.append((int(u), float(v)))
-        self.timestamp, self.length = struct.unpack("<QI", f.read(12))
-        self.replay = replay = deque()
-        flip = flip_hr and self.has_mod(16)
-        t = 0
-        for rec in lzma.decompress(f.read(self.length)).decode().split(","):
-            if rec:
-                w, x, y, z = rec.split("|")
-                w, x, y, z = int(w), float(x), float(y), int(z)
-                t += w
-                if flip:
-                    y = 384 - y
-                p = ReplayPoint(t, x, y, z)
-                replay.append(p)
+        self.timestamp, self.length = TAIL.unpack_from(buf, offset)
+        return offset + TAIL.size
+
+    def read_buffer(self, buf, offset=0, flip_hr=False, lazy=False, path=None):
+        """Read a replay starting at offset in a bytes-like object.
+
+        Returns the offset just past the replay, including the online score
+        id after the frames if it's there. The compressed frames are
+        decompressed straight out of buf without copying them. With lazy=True
+        they're kept for later instead, or if buf is the contents of path,
+        read back from there when they're needed.
+        """
+        offset = self.read_header(buf, offset)
+        end = offset + self.length
+        if end > len(buf):
+            raise EOFError("replay data ended before the compressed frames did")
+        self.offset = offset
+        self._flip = flip_hr and self.has_mod(16)
+        self.path = None
+        self._payload = None
+        if not lazy:
+            self._decode(memoryview(buf)[offset:end])
+        elif path is not None:
+            self.path = path
+        else:
+            self._payload = bytes(buf[offset:end])
+        if self.version >= SCORE_ID_VERSION and end + SCORE_ID.size <= len(buf):
+            end += SCORE_ID.size
+        return end
+
+    def read_file(self, f, flip_hr=False, lazy=False):
+        buf, offset = _buffer(f)
+        path = getattr(f, "name", None)
+        if not isinstance(buf, mmap.mmap) or not isinstance(path, str):
+            path = None
+        end = self.read_buffer(buf, offset, flip_hr, lazy, path)
+        # leave f just past the replay so the next one in it can be read
+        if isinstance(buf, mmap.mmap):
+            f.seek(end)
+        elif f.seekable():
+            f.seek(end - len(buf), io.SEEK_CUR)
+
+    def _decode(self, payload):
+        data = lzma.decompress(payload).decode()
+        self.t, self.x, self.y, self.z, self.seed = decode_frames(data, self._flip)
+
+    def load_frames(self):
+        """Decompress the frames of a replay that was read with lazy=True."""
+        payload = self._payload
+        if payload is None:
+            with open(self.path, "rb") as f:
+                buf, _ = _buffer(f)
+            payload = memoryview(buf)[self.offset : self.offset + self.length]
+        self._decode(payload)
+        self._payload = None
+
+    def __getattr__(self, name):
+        # only called for unset slots, i.e. frames that haven't been loaded yet
+        if name in FRAME_FIELDS:
+            self.load_frames()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    def header(self):
+        """The header fields as a json-friendly dict."""
+        header = {name: getattr(self, name) for name in HEADER_FIELDS}
+        header["life_events"] = list(self.life_events)
+        return header
+
+    @classmethod
+    def from_header(cls, header, flip=False):
+        """A replay with the fields from header and no frames yet.
+
+        flip says whether the frames that will be set have been HR flipped.
+        """
+        r = cls()
+        for name in HEADER_FIELDS:
+            setattr(r, name, header[name])
+        r.life_events = deque(map(tuple, r.life_events))
+        r.path = None
+        r.offset = None
+        r._payload = None
+        r._flip = flip
+        return r
+
+    def to_bytes(self):
+        """Encode the replay as an .osr file.
+
+        The frames are re-encoded from the stored columns, so the result is
+        equivalent to the original file rather than identical to it, and
+        the online score id after the frames is written as 0.
+        """
+        y = flip_y(self.y) if self._flip else self.y
+        data = encode_frames(self.t, self.x, y, self.z, self.seed)
+        payload = lzma.compress(data.encode(), format=lzma.FORMAT_ALONE)
+        life_bar = "".join("%d|%s," % event for event in self.life_events)
+        return b"".join(
+            [
+                HEAD.pack(self.mode, self.version),
+                encode_string(self.beatmap_hash),
+                encode_string(self.player),
+                encode_string(self.replay_hash),
+                SCORE.pack(
+                    self.n300,
+                    self.n100,
+                    self.n50,
+                    self.ngeki,
+                    self.nkatu,
+                    self.nmiss,
+                    self.score,
+                    self.combo,
+                    self.perfect,
+                    self.mods,
+                ),
+                encode_string(life_bar),
+                TAIL.pack(self.timestamp, len(payload)),
+                payload,
+                SCORE_ID.pack(0),
+            ]
+        )
 
     def has_mod(self, mod):
         return self.mods & mod == mod
 
+    @property
+    def replay(self):
+        """The frames as a deque of ReplayPoints, for code that consumes them."""
+        return deque(self)
+
     def __len__(self):
-        return len(self.replay)
+        return len(self.t)
+
+    def __getitem__(self, i):
+        if i >= len(self):
+            i = -1
+        return ReplayPoint(
+            int(self.t[i]), float(self.x[i]), float(self.y[i]), int(self.z[i])
+        )
+
+    def __iter__(self):
+        return map(
+            ReplayPoint,
+            self.t.tolist(),
+            self.x.tolist(),
+            self.y.tolist(),
+            self.z.tolist(),
+        )
+
+    @property
+    def time_index(self):
+        """The time each frame becomes the current one, in ascending order.
+
+        Frames play back in file order, so one with a negative w only becomes
+        current once every frame before it has: this is the running maximum
+        of t, and searching it gives the same frame consuming them would.
+        """
+        try:
+            return self._index
+        except AttributeError:
+            self._index = np.maximum.accumulate(self.t)
+            return self._index
+
+    @property
+    def key_mask(self):
+        """The keys held at each frame, as a key_mask of z."""
+        try:
+            return self._keys
+        except AttributeError:
+            self._keys = key_mask(self.z)
+            return self._keys
 
-    def __getitem__(self, t):
-        if t < len(self):
-            return self.replay[t]
-        return self.replay[-1]
+    def index_at(self, times):
+        """Index of the current frame at each of times, -1 before the first."""
+        return np.searchsorted(self.time_index, times, "right") - 1
+
+    def sample(self, times, interpolate=False):
+        """Look up the cursor at every one of times at once.
+
+        Returns Frames with times as t. Times before the first frame get the
+        first frame. With interpolate=True, x and y move linearly towards the
+        next frame instead of holding until it arrives; z never interpolates.
+        """
+        times = np.asarray(times)
+        i = np.maximum(self.index_at(times), 0)
+        x, y, z = self.x[i], self.y[i], self.z[i]
+        if interpolate:
+            index = self.time_index
+            j = np.minimum(i + 1, len(self) - 1)
+            span = index[j] - index[i]
+            frac = np.clip((times - index[i]) / np.maximum(span, 1), 0, 1)
+            frac = np.where(span > 0, frac, 0)
+            x = x + (self.x[j] - x) * frac
+            y = y + (self.y[j] - y) * frac
+        return Frames(times, x, y, z)
+
+    def position_at(self, t, interpolate=False):
+        """The cursor's (x, y) at time t, see sample."""
+        frames = self.sample(t, interpolate)
+        return float(frames.x), float(frames.y)
+
+    def keys_at(self, t):
+        """The keys held at time t, in the same order keys yields them."""
+        mask = int(self.key_mask[max(int(self.index_at(t)), 0)])
+        return tuple(bool(mask & key) for key in KEYS)
 
     def _key(self):
         return (self.score, -self.timestamp, self.player)
@@ -199,10 +701,113 @@ class Replay:
         return self._key() < other._key()
 
 
-def read_file(f, flip_hr=False):
-    if isinstance(f, str):
+def read_file(f, flip_hr=False, lazy=False, cache=None):
+    """Read a replay from a path, a file object or a bytes-like object.
+
+    With lazy=True only the header and life bar are parsed; the frames are
+    decompressed the first time one of them (or .replay) is accessed.
+
+    cache is an optional replay_cache.ReplayCache; paths found in it are
+    loaded from there without parsing, and fully read ones are added to it.
+    """
+    if isinstance(f, (str, os.PathLike)):
+        f = os.fspath(f)
+        if cache is not None:
+            r = cache.load(f, flip_hr)
+            if r is not None:
+                return r
         with open(f, "rb") as ff:
-            return read_file(ff, flip_hr)
+            r = read_file(ff, flip_hr, lazy)
+        if cache is not None and not lazy:
+            cache.store(f, flip_hr, r)
+        return r
     r = Replay()
-    r.read_file(f, flip_hr)
+    if isinstance(f, BUFFER_TYPES):
+        r.read_buffer(f, 0, flip_hr, lazy)
+    else:
+        r.read_file(f, flip_hr, lazy)
     return r
+
+
+def find_replays(paths, recursive=True):
+    """Yield the replays at paths, which are .osr files or folders of them.
+
+    The .osr files in a folder, and in its subfolders unless recursive is
+    false, come out sorted.
+    """
+    pattern = os.path.join("**", "*.osr") if recursive else "*.osr"
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob(os.path.join(path, pattern), recursive=recursive))
+        else:
+            yield path
+
+
+ReadResult = namedtuple("ReadResult", "path replay error")
+
+
+def _read_one(path, flip_hr, cache=None):
+    try:
+        return ReadResult(path, read_file(path, flip_hr, cache=cache), None)
+    except Exception as e:
+        return ReadResult(path, None, e)
+
+
+def windowed(submit, items, size, ordered=True):
+    """Yield (item, submit(item)) for each of items, submitting only a few ahead.
+
+    submit returns a future. At most size items are submitted but not yet
+    yielded, so finished results don't pile up faster than they're used.
+    They come in the order of items or, with ordered=False, as each one
+    finishes. Any not yielded are cancelled if the generator is closed early.
+    """
+    items = iter(items)
+    pending = deque((item, submit(item)) for item in islice(items, size))
+    try:
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                finished, _ = futures.wait(
+                    [future for _, future in pending],
+                    return_when=futures.FIRST_COMPLETED,
+                )
+                done = [p for p in pending if p[1] in finished]
+                pending = deque(p for p in pending if p[1] not in finished)
+            pending.extend((item, submit(item)) for item in islice(items, len(done)))
+            yield from done
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def read_many(paths, flip_hr=False, workers=None, ordered=True, cache=None):
+    """Read many replay files in worker processes.
+
+    Yields a ReadResult(path, replay, error) per path, in the order of paths
+    or, with ordered=False, as soon as each one is done. A file that fails to
+    parse gets replay=None and the exception as its error instead of stopping
+    the others. workers=1 reads everything in this process.
+
+    Only a few files per worker are in flight at once and nothing is kept
+    once it's yielded, so memory doesn't grow with the number of paths.
+    Replays found in cache are loaded here and only the rest are sent to the
+    workers, which add them to the cache.
+    """
+    if workers == 1:
+        for path in paths:
+            yield _read_one(path, flip_hr, cache)
+        return
+    workers = workers or os.cpu_count()
+    with futures.ProcessPoolExecutor(workers) as pool:
+
+        def submit(path):
+            replay = cache.load(path, flip_hr) if cache is not None else None
+            if replay is None:
+                return pool.submit(_read_one, path, flip_hr, cache)
+            future = futures.Future()
+            future.set_result(ReadResult(path, replay, None))
+            return future
+
+        for _, future in windowed(submit, paths, workers * 2, ordered):
+            yield future.result()
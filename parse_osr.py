@@ -3,6 +3,10 @@ import struct
 import sys
 from textwrap import dedent
 
+import numpy as np
+
+import osr
+
 
 def parse_uleb128(f):
     result = 0
@@ -124,21 +128,14 @@ def to_bin(n, size):
     return s
 
 
-def keys(n):
-    k1 = n & 5 == 5
-    k2 = n & 10 == 10
-    m1 = not k1 and n & 1 == 1
-    m2 = not k2 and n & 2 == 2
-    smoke = n & 16 == 16
-    return " ".join(
-        [
-            ("K1" if k1 else "  "),
-            ("K2" if k2 else "  "),
-            ("M1" if m1 else "  "),
-            ("M2" if m2 else "  "),
-            ("SMOKE" if smoke else "     "),
-        ]
+# the keys column for every key mask
+KEYS = [
+    " ".join(
+        name if mask & key else " " * len(name)
+        for key, name in zip(osr.KEYS, osr.KEY_NAMES)
     )
+    for mask in range(1 << len(osr.KEYS))
+]
 
 
 path = sys.argv[1]
@@ -155,14 +152,16 @@ with open(path, "rb") as f:
     timestamp, length = struct.unpack("<QI", f.read(12))
 
     data = lzma.decompress(f.read(length)).decode()
-    last_w = 0
-    for record in data.split(","):
-        if record:
-            w, x, y, z = record.split("|")
-            w, z = int(w), int(z)
-            x, y = float(x), float(y)
-            print("%10d %10.4f %10.4f %s" % (w, x, y, keys(z)))
-            last_w = w
+    records = [record.split("|") for record in data.split(",") if record]
+    if records:
+        w, x, y, z = zip(*records)
+        masks = osr.key_mask(np.array(z, np.int64)).tolist()
+        rows = zip(map(int, w), map(float, x), map(float, y), masks)
+        sys.stdout.write(
+            "".join(
+                "%10d %10.4f %10.4f %s\n" % (w, x, y, KEYS[m]) for w, x, y, m in rows
+            )
+        )
 
     print(
         dedent(
@@ -0,0 +1,44 @@
+PLAYFIELD_WIDTH = 512
+PLAYFIELD_HEIGHT = 384
+
+# Where the osu! client draws the playfield on a 1366x768 window, which helps
+# with easy overlay for video. Other sizes are scaled from this by height.
+CLIENT_WIDTH = 1366
+CLIENT_HEIGHT = 768
+CLIENT_LEFT = 273
+CLIENT_TOP = 89
+CLIENT_SCALE = 1.551
+
+
+class Playfield:
+    """Where the 512x384 osu! playfield goes on an image.
+
+    Calling it maps osu! pixels to image pixels, x * scale + left and
+    y * scale + top, for numbers or numpy arrays alike.
+    """
+
+    def __init__(self, scale, left=0, top=0):
+        self.scale = scale
+        self.left = left
+        self.top = top
+
+    @classmethod
+    def fit(cls, height):
+        """The playfield filling the height of an image, at its left edge."""
+        return cls(height / PLAYFIELD_HEIGHT)
+
+    @classmethod
+    def client(cls, width, height):
+        """The playfield where the osu! client would draw it."""
+        k = height / CLIENT_HEIGHT
+        # centered horizontally like the client does on wider screens
+        left = CLIENT_LEFT * k + (width - CLIENT_WIDTH * k) / 2
+        return cls(CLIENT_SCALE * k, left, CLIENT_TOP * k)
+
+    def __call__(self, x, y):
+        return x * self.scale + self.left, y * self.scale + self.top
+
+
+def keysize(width, height, replays):
+    """The size of the key boxes in the panel right of a 4:3 playfield area."""
+    return min((width - height * 4 / 3) / 5, height / replays)
@@ -0,0 +1,174 @@
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+
+# Canvases draw a frame's trails, cursors and key boxes, given as lists of
+# (points, color), ((x, y), color) and ((x0, y0, x1, y1), color), points
+# being an (n, 2) array. PilCanvas
+# makes a PIL.ImageDraw call per shape; ArrayCanvas rasterizes each kind of
+# shape into a numpy framebuffer all at once, so its cost goes with the number
+# of pixels drawn rather than the number of shapes.
+
+
+class PilCanvas:
+    """Draws with PIL.ImageDraw, always into the same image."""
+
+    def __init__(self, width, height):
+        self.size = (width, height)
+        self.im = PIL.Image.new("RGB", self.size)
+        self.draw = PIL.ImageDraw.Draw(self.im)
+
+    def clear(self):
+        self.im.paste((0, 0, 0), (0, 0) + self.size)
+
+    def lines(self, lines, width):
+        for points, color in lines:
+            self.draw.line(points.ravel().tolist(), color, width)
+
+    def circles(self, circles, radius):
+        for (x, y), color in circles:
+            self.draw.ellipse(
+                (x - radius, y - radius, x + radius, y + radius), color, (0, 0, 0)
+            )
+
+    def rects(self, rects):
+        for rect, color in rects:
+            self.draw.rectangle(rect, color)
+
+    def image(self, out=None):
+        """The frame drawn so far, copied into out if it's given.
+
+        Without out, it's the canvas's own image, which later drawing changes.
+        """
+        if out is None:
+            return self.im
+        out.paste(self.im)
+        return out
+
+
+def disc(radius):
+    """Pixel offsets of a disc with a 1px outline, as drawn by PIL.
+
+    Returns the rows, the columns and whether each pixel is inside rather
+    than on the outline, with the inside first.
+    """
+    size = 2 * radius + 1
+    im = PIL.Image.new("L", (size, size))
+    PIL.ImageDraw.Draw(im).ellipse((0, 0, size - 1, size - 1), 1, 2)
+    a = np.asarray(im)
+    fill = np.nonzero(a == 1)
+    outline = np.nonzero(a == 2)
+    dy = np.concatenate([fill[0], outline[0]]) - radius
+    dx = np.concatenate([fill[1], outline[1]]) - radius
+    inside = np.arange(len(dy)) < len(fill[0])
+    return dy, dx, inside
+
+
+def pack(colors):
+    """RGB colors packed into the uint32s of an RGBX framebuffer."""
+    c = np.array(colors, np.uint32).reshape(-1, 3)
+    return c[:, 0] | c[:, 1] << 8 | c[:, 2] << 16
+
+
+class ArrayCanvas:
+    """Rasterizes into a numpy framebuffer.
+
+    The framebuffer holds a packed RGBX uint32 per pixel, so a pixel is set by
+    a single store, and has pad pixels of padding around it that anything off
+    screen is clamped into. Cursors are stamped from a disc drawn once per
+    radius, trails are split into segments that are all sampled together, and
+    key boxes are filled from slices of the framebuffer's pixel indices.
+    Shapes are still drawn over each other in the order given.
+    """
+
+    def __init__(self, width, height, pad=8):
+        self.size = (width, height)
+        self.pad = pad
+        self.stride = width + 2 * pad
+        self._fb = np.zeros((height + 2 * pad, self.stride), np.uint32)
+        self.fb = self._fb[pad:-pad, pad:-pad]
+        self._discs = {}
+        self._rects = None
+
+    def clear(self):
+        self._fb.fill(0)
+
+    def _index(self, y, x, margin=0):
+        # flat indices into the padded framebuffer, clamped to leave margin
+        # pixels of padding that offsets from them can still land in
+        width, height = self.size
+        pad = self.pad
+        y = np.clip(y, margin - pad, height + pad - margin - 1) + pad
+        x = np.clip(x, margin - pad, width + pad - margin - 1) + pad
+        return y * self.stride + x
+
+    def lines(self, lines, width):
+        """Draw polylines width pixels wide, for widths less than pad."""
+        if not lines:
+            return
+        counts = [len(points) for points, _ in lines]
+        p = np.concatenate([points for points, _ in lines])
+        colors = np.repeat(pack([color for _, color in lines]), counts)
+
+        # segments between consecutive points of the same line
+        keep = np.ones(len(p) - 1, bool)
+        keep[np.cumsum(counts)[:-1] - 1] = False
+        a = p[:-1][keep]
+        d = p[1:][keep] - a
+        colors = colors[:-1][keep]
+
+        # one sample per pixel along each segment's major axis
+        n = np.ceil(np.abs(d).max(axis=1)).astype(np.intp) + 1
+        step = d / np.maximum(n - 1, 1)[:, None]
+        seg = np.repeat(np.arange(len(n)), n)
+        k = np.arange(len(seg)) - np.repeat(np.cumsum(n) - n, n)
+        x = np.rint(a[seg, 0] + step[seg, 0] * k).astype(np.intp)
+        y = np.rint(a[seg, 1] + step[seg, 1] * k).astype(np.intp)
+
+        # widened along the minor axis
+        minor = np.where(np.abs(d[:, 1]) > np.abs(d[:, 0]), 1, self.stride)
+        offsets = np.arange(width) - (width - 1) // 2
+        index = self._index(y, x, width // 2)[:, None] + minor[seg, None] * offsets
+        self._fb.ravel()[index.ravel()] = np.repeat(colors[seg], width)
+
+    def circles(self, circles, radius):
+        if not circles:
+            return
+        if radius not in self._discs:
+            self._discs[radius] = disc(radius)
+        dy, dx, inside = self._discs[radius]
+        centers = np.rint(np.array([c for c, _ in circles])).astype(np.intp)
+        colors = pack([color for _, color in circles])
+        index = self._index(centers[:, 1, None] + dy, centers[:, 0, None] + dx)
+        self._fb.ravel()[index.ravel()] = np.where(inside, colors[:, None], 0).ravel()
+
+    def rects(self, rects):
+        if not rects:
+            return
+        # the boxes usually stay put from frame to frame, so the pixels each
+        # one covers are kept until they move
+        bounds = [rect for rect, _ in rects]
+        if bounds != self._rects:
+            index = np.arange(self._fb.size).reshape(self._fb.shape)
+            index = index[self.pad : -self.pad, self.pad : -self.pad]
+            pixels = [
+                index[int(y0) : int(y1) + 1, int(x0) : int(x1) + 1].ravel()
+                for x0, y0, x1, y1 in bounds
+            ]
+            self._rects = bounds
+            self._rect_index = np.concatenate(pixels)
+            self._rect_ids = np.repeat(np.arange(len(pixels)), [len(p) for p in pixels])
+        colors = pack([color for _, color in rects])
+        self._fb.ravel()[self._rect_index] = colors[self._rect_ids]
+
+    def image(self, out=None):
+        """The frame drawn so far, loaded into out if it's given."""
+        start = self.pad * self.stride + self.pad
+        args = (self._fb.ravel()[start:], "raw", "RGBX", self.stride * 4, 1)
+        if out is None:
+            return PIL.Image.frombytes("RGB", self.size, *args)
+        out.frombytes(*args)
+        return out
+
+
+BACKENDS = {"pil": PilCanvas, "numpy": ArrayCanvas}
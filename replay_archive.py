@@ -0,0 +1,182 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import osr
+
+# An archive starts with a fixed preamble pointing at the index, followed by
+# the frames of every replay and then the index itself. Each replay's frames
+# are stored as four zlib compressed columns (w, x, y, z), w being t's deltas
+# so it compresses well. The index is zlib compressed json with one entry per
+# replay: its header, seed, frame count and where its columns are. Replays of
+# the same beatmap are packed next to each other, best score first.
+MAGIC = b"OSRA"
+VERSION = 1
+PREAMBLE = struct.Struct("<4sIQQ")
+
+COLUMNS = [("w", np.int64), ("x", np.float32), ("y", np.float32), ("z", np.uint8)]
+
+
+def pack(paths, out, level=1, workers=None):
+    """Pack the replays at paths (files or folders of them) into out.
+
+    Returns the unreadable files and their errors.
+    """
+    errors = []
+    headers = []
+    for path in osr.find_replays(paths):
+        try:
+            headers.append((osr.read_file(path, lazy=True), path))
+        except Exception as e:
+            errors.append((path, e))
+    headers.sort(key=lambda h: (h[0].beatmap_hash, -h[0].score, h[0].timestamp))
+
+    entries = []
+    with open(out, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, VERSION, 0, 0))
+        results = osr.read_many([path for _, path in headers], workers=workers)
+        for path, replay, error in results:
+            if error:
+                errors.append((path, error))
+                continue
+            entry = replay.header()
+            entry["seed"] = replay.seed
+            entry["frames"] = len(replay)
+            entry["columns"] = []
+            w = np.diff(replay.t, prepend=0)
+            for column, (_, dtype) in zip((w, replay.x, replay.y, replay.z), COLUMNS):
+                data = zlib.compress(np.ascontiguousarray(column, dtype), level)
+                entry["columns"].append((f.tell(), len(data)))
+                f.write(data)
+            entries.append(entry)
+        index = zlib.compress(json.dumps(entries).encode(), level)
+        offset = f.tell()
+        f.write(index)
+        f.seek(0)
+        f.write(PREAMBLE.pack(MAGIC, VERSION, offset, len(index)))
+    return errors
+
+
+class Archive:
+    """Read access to a replay archive written by pack.
+
+    Opening one reads just the preamble and the index; frames are only read
+    and decompressed for the replays asked for.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, offset, length = PREAMBLE.unpack_from(self._buf)
+        if magic != MAGIC:
+            raise ValueError("%s is not a replay archive" % path)
+        if version != VERSION:
+            raise ValueError("%s is archive version %d" % (path, version))
+        self.entries = json.loads(zlib.decompress(self._buf[offset : offset + length]))
+        self.beatmaps = {}
+        for entry in self.entries:
+            self.beatmaps.setdefault(entry["beatmap_hash"], []).append(entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def find(self, beatmap_hash=None, player=None, mods=None):
+        """Index entries matching all of the given fields, best score first.
+
+        mods matches entries that have at least those mods.
+        """
+        if beatmap_hash is None:
+            entries = sorted(self.entries, key=lambda e: -e["score"])
+        else:
+            entries = self.beatmaps.get(beatmap_hash, [])
+        return [
+            e
+            for e in entries
+            if (player is None or e["player"] == player)
+            and (mods is None or e["mods"] & mods == mods)
+        ]
+
+    def read(self, entry, flip_hr=False):
+        """Load the replay for an index entry."""
+        r = osr.Replay.from_header(entry, flip_hr and entry["mods"] & 16 == 16)
+        r.seed = entry["seed"]
+        count = entry["frames"]
+        w, r.x, y, r.z = (
+            np.frombuffer(zlib.decompress(self._buf[offset : offset + length]), dtype)
+            for (offset, length), (_, dtype) in zip(entry["columns"], COLUMNS)
+        )
+        assert len(w) == count, "archive entry has the wrong number of frames"
+        r.t = np.cumsum(w)
+        r.y = osr.flip_y(y) if r._flip else y
+        return r
+
+    def read_beatmap(self, beatmap_hash, flip_hr=False):
+        """Load every replay of a beatmap, best score first."""
+        return [self.read(e, flip_hr) for e in self.find(beatmap_hash)]
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def unpack(path, out):
+    """Write every replay in the archive at path to out as .osr files."""
+    os.makedirs(out, exist_ok=True)
+    with Archive(path) as archive:
+        for entry in archive:
+            name = os.path.join(out, "%s.osr" % entry["replay_hash"])
+            with open(name, "wb") as f:
+                f.write(archive.read(entry).to_bytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="osu! replay archives")
+    commands = parser.add_subparsers(dest="command", required=True)
+    p = commands.add_parser("pack", help="pack replays into an archive")
+    p.add_argument("archive", help="archive to write")
+    p.add_argument("paths", nargs="+", help="replays or folders containing them")
+    p.add_argument("-l", "--level", help="zlib level", type=int, default=1)
+    p = commands.add_parser("unpack", help="write an archive's replays out")
+    p.add_argument("archive", help="archive to read")
+    p.add_argument("out", help="folder to write the replays to")
+    p = commands.add_parser("list", help="list the replays in an archive")
+    p.add_argument("archive", help="archive to read")
+    p.add_argument("-b", "--beatmap", help="only replays of this beatmap hash")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        for path, error in pack(args.paths, args.archive, args.level):
+            sys.stderr.write("%s: %s\n" % (path, error))
+    elif args.command == "unpack":
+        unpack(args.archive, args.out)
+    else:
+        with Archive(args.archive) as archive:
+            for e in archive.find(args.beatmap):
+                print(
+                    "%s %15s %10d %-8s %d frames"
+                    % (
+                        e["beatmap_hash"],
+                        e["player"],
+                        e["score"],
+                        osr.shortmods(e["mods"]),
+                        e["frames"],
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+import osr
+
+DEFAULT_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "osr-viewer",
+    "replays",
+)
+DEFAULT_SIZE = 1 << 30
+
+# magic, format version, header json length, frame count
+MAGIC = b"OSRC"
+VERSION = 3
+PREAMBLE = struct.Struct("<4sIII")
+
+COLUMNS = [("t", np.int64), ("x", np.float32), ("y", np.float32), ("z", np.uint8)]
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class ReplayCache:
+    """Decoded replays stored on disk, keyed by path, size, mtime and flip.
+
+    Each entry is one file: a small json header followed by the t, x, y and z
+    columns back to back, so loading one is an mmap and no parsing at all.
+    Once the entries take more than max_size bytes the least recently used
+    ones are removed.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_size=DEFAULT_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._size = None
+
+    def _entry(self, path, flip_hr):
+        st = os.stat(path)
+        key = "%s\0%d\0%d\0%d" % (
+            os.path.abspath(path),
+            st.st_size,
+            st.st_mtime_ns,
+            flip_hr,
+        )
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest())
+
+    def load(self, path, flip_hr=False):
+        """Return the cached replay for path, or None if there isn't one.
+
+        An entry that can't be read, say because it was cut short, is removed
+        so that the replay is decoded and stored again.
+        """
+        try:
+            entry = self._entry(path, flip_hr)
+        except OSError:
+            return None
+        try:
+            with open(entry, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # mmap refuses empty files
+            self._discard(entry)
+            return None
+        try:
+            return self._read(buf, path)
+        except Exception:
+            self._discard(entry)
+            return None
+
+    def _read(self, buf, path):
+        magic, version, size, count = PREAMBLE.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a replay cache entry of this version")
+        offset = PREAMBLE.size
+        header = json.loads(bytes(buf[offset : offset + size]))
+        offset = _align(offset + size)
+        r = osr.Replay.from_header(header, header["flip"])
+        r.seed = header["seed"]
+        r.path = path
+        r.offset = header["offset"]
+        for name, dtype in COLUMNS:
+            setattr(r, name, np.frombuffer(buf, dtype, count, offset))
+            offset = _align(offset + count * np.dtype(dtype).itemsize)
+        return r
+
+    def _discard(self, entry):
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+
+    def store(self, path, flip_hr, replay):
+        """Add a fully read replay to the cache.
+
+        The cache is only a shortcut, so if it can't be written to the replay
+        just isn't added.
+        """
+        header = replay.header()
+        header["seed"] = replay.seed
+        header["offset"] = replay.offset
+        header["flip"] = replay._flip
+        header = json.dumps(header).encode()
+        count = len(replay)
+        chunks = [PREAMBLE.pack(MAGIC, VERSION, len(header), count), header]
+        offset = PREAMBLE.size + len(header)
+        for name, dtype in COLUMNS:
+            chunks.append(bytes(_align(offset) - offset))
+            column = np.ascontiguousarray(getattr(replay, name), dtype)
+            chunks.append(column.tobytes())
+            offset = _align(offset) + column.nbytes
+
+        tmp = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            entry = self._entry(path, flip_hr)
+            # write under a temporary name so readers never see half an entry
+            tmp = "%s.%d.tmp" % (entry, os.getpid())
+            with open(tmp, "wb") as f:
+                f.writelines(chunks)
+            os.replace(tmp, entry)
+        except OSError:
+            if tmp is not None:
+                self._discard(tmp)
+            return
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += offset
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        entries = []
+        try:
+            it = os.scandir(self.path)
+        except OSError:
+            return entries
+        with it:
+            for e in it:
+                if e.is_file() and not e.name.endswith(".tmp"):
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        # removed by another process since the scan
+                        continue
+                    entries.append((e.path, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_size."""
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self._size = sum(size for _, size, _ in entries)
+        for entry, size, _ in entries:
+            if self._size <= self.max_size:
+                break
+            # an entry another process has mapped can't always be removed
+            self._discard(entry)
+            self._size -= size
+
+    def clear(self):
+        for entry, _, _ in self._entries():
+            os.remove(entry)
+        self._size = 0
@@ -0,0 +1,229 @@
+import argparse
+import os
+import sqlite3
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import osr
+import replay_cache
+
+DEFAULT_PATH = os.path.join(os.path.dirname(replay_cache.DEFAULT_PATH), "index.sqlite")
+
+FIELDS = (
+    "path",
+    "size",
+    "mtime",
+    "beatmap_hash",
+    "player",
+    "score",
+    "combo",
+    "mods",
+    "timestamp",
+    "replay_hash",
+    "frames",
+)
+
+Row = namedtuple("Row", FIELDS)
+
+SCHEMA = """
+create table if not exists replays (
+    path text primary key,
+    size integer not null,
+    mtime integer not null,
+    beatmap_hash text not null,
+    player text not null,
+    score integer not null,
+    combo integer not null,
+    mods integer not null,
+    timestamp integer not null,
+    replay_hash text not null,
+    frames integer not null
+);
+create index if not exists replays_beatmap on replays (beatmap_hash, score);
+"""
+
+
+def _in_folder(folder, recursive):
+    # sql condition matching paths in folder (absolute), and its parameters
+    sql = "substr(path, 1, ?) = ?"
+    params = [len(folder) + 1, folder + os.sep]
+    if not recursive:
+        sql += " and instr(substr(path, ?), ?) = 0"
+        params += [len(folder) + 2, os.sep]
+    return sql, params
+
+
+def _scan(path, size, mtime):
+    try:
+        r = osr.read_file(path, lazy=True)
+        row = Row(
+            path,
+            size,
+            mtime,
+            r.beatmap_hash,
+            r.player,
+            r.score,
+            r.combo,
+            r.mods,
+            r.timestamp,
+            r.replay_hash,
+            len(r),
+        )
+        return row, None
+    except Exception as e:
+        return path, e
+
+
+class ReplayIndex:
+    """Replay header metadata for a corpus of .osr files, kept in SQLite.
+
+    Refreshing only reads files that are new or whose size or mtime changed
+    since they were indexed, so selecting replays doesn't mean opening every
+    one of them.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def refresh(self, folder, recursive=True, workers=None):
+        """Bring the index up to date with the .osr files in folder.
+
+        Returns the files that couldn't be read and their errors.
+        """
+        folder = os.path.abspath(folder)
+        pattern = "**/*.osr" if recursive else "*.osr"
+        seen = {}
+        for path in glob(os.path.join(folder, pattern), recursive=recursive):
+            st = os.stat(path)
+            seen[path] = (st.st_size, st.st_mtime_ns)
+
+        sql, params = _in_folder(folder, recursive)
+        known = {
+            path: (size, mtime)
+            for path, size, mtime in self.db.execute(
+                "select path, size, mtime from replays where " + sql, params
+            )
+        }
+        gone = [(path,) for path in known if path not in seen]
+        changed = [
+            (path, size, mtime)
+            for path, (size, mtime) in seen.items()
+            if known.get(path) != (size, mtime)
+        ]
+
+        errors = []
+        rows = []
+        if changed:
+            with ProcessPoolExecutor(workers) as pool:
+                for row, error in pool.map(_scan, *zip(*changed), chunksize=16):
+                    if error:
+                        errors.append((row, error))
+                    else:
+                        rows.append(row)
+        with self.db:
+            self.db.executemany("delete from replays where path = ?", gone)
+            self.db.executemany(
+                "insert or replace into replays values (%s)"
+                % ", ".join("?" * len(FIELDS)),
+                rows,
+            )
+        return errors
+
+    def select(
+        self,
+        folder=None,
+        beatmap_hash=None,
+        mods=None,
+        player=None,
+        top=None,
+        recursive=True,
+    ):
+        """Indexed replays matching all of the given fields, best score first.
+
+        mods matches replays that have at least those mods.
+        """
+        where = []
+        params = []
+        if folder is not None:
+            sql, folder_params = _in_folder(os.path.abspath(folder), recursive)
+            where.append(sql)
+            params += folder_params
+        if beatmap_hash is not None:
+            where.append("beatmap_hash = ?")
+            params.append(beatmap_hash)
+        if mods:
+            where.append("mods & ? = ?")
+            params += [mods, mods]
+        if player is not None:
+            where.append("player = ?")
+            params.append(player)
+        sql = "select * from replays"
+        if where:
+            sql += " where " + " and ".join(where)
+        sql += " order by score desc, timestamp asc"
+        if top is not None:
+            sql += " limit ?"
+            params.append(top)
+        return [Row(*row) for row in self.db.execute(sql, params)]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def add_arguments(parser):
+    """Add the options for picking replays through the index to parser."""
+    parser.add_argument("-n", "--top", help="only the best N replays", type=int)
+    parser.add_argument("-b", "--beatmap", help="only replays of this beatmap hash")
+    parser.add_argument(
+        "-m",
+        "--mods",
+        help="only replays with these mods, e.g. HDHR",
+        type=osr.parse_mods,
+    )
+
+
+def select_files(args, folder, recursive=True):
+    """The replay files in folder picked by the options from add_arguments."""
+    with ReplayIndex() as index:
+        for path, error in index.refresh(folder, recursive):
+            sys.stderr.write("%s: %s\n" % (path, error))
+        rows = index.select(
+            folder, args.beatmap, args.mods, top=args.top, recursive=recursive
+        )
+    return [row.path for row in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="index a folder of osu! replays")
+    parser.add_argument("path", help="folder containing replays")
+    parser.add_argument("-d", "--db", help="index database", default=DEFAULT_PATH)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    with ReplayIndex(args.db) as index:
+        for path, error in index.refresh(args.path):
+            sys.stderr.write("%s: %s\n" % (path, error))
+        rows = index.select(args.path, args.beatmap, args.mods, top=args.top)
+
+    n = 1
+    for row in rows:
+        print(
+            "%2d. %15s - %d %s %s"
+            % (n, row.player, row.score, osr.shortmods(row.mods), row.beatmap_hash)
+        )
+        n += 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+
+
+class Timeline:
+    """A set of replays resampled onto a fixed frame clock.
+
+    Frame f is at int(f * 1000 / fps) ms. For every frame from start to end
+    (exclusive) and every replay, index holds the replay frame that is current
+    then, with the same "latest frame at or before it" rule as playing the
+    replay back frame by frame (see osr.Replay.time_index), and -1 before its
+    first frame. x, y and keys are the cursor and the keys held (see
+    osr.key_mask) at that replay frame, 0 before the first one. All of them
+    are (frames, replays) arrays, row r being frame start + r.
+    """
+
+    def __init__(self, replays, fps=60, start=0, end=None):
+        self.replays = []
+        self.fps = fps
+        self.interval = 1000 / fps
+        self.start = start
+        self.end = start
+        # without an end, the timeline grows to fit the replays added
+        self.fixed = end is not None
+        self.times = np.empty(0, np.int64)
+        self._index = np.empty((0, 0), np.int32)
+        self._x = np.empty((0, 0), np.float32)
+        self._y = np.empty((0, 0), np.float32)
+        self._keys = np.empty((0, 0), np.uint8)
+        self._views()
+        if self.fixed:
+            self._resize(end, 0)
+        self.extend(replays)
+
+    def extend(self, replays):
+        """Add replays, growing the timeline to fit them unless end was given.
+
+        Columns are allocated with room to spare, so adding replays a few at a
+        time doesn't copy all of the others every time.
+        """
+        replays = list(replays)
+        if not replays:
+            return
+        end = self.end
+        if not self.fixed:
+            longest = max(int(replay.t.max(initial=0)) for replay in replays)
+            end = max(end, math.ceil(longest / self.interval))
+        n = len(self.replays) + len(replays)
+        capacity = self._x.shape[1]
+        if n > capacity:
+            capacity = max(n, capacity * 2)
+        if end != self.end or capacity != self._x.shape[1]:
+            self._resize(end, capacity)
+        for j, replay in enumerate(replays, len(self.replays)):
+            self._fill(j, replay, slice(None))
+        self.replays += replays
+        self._views()
+
+    def _resize(self, end, capacity):
+        rows = len(self.times)
+        n = len(self.replays)
+        self.end = end
+        self.times = (np.arange(self.start, end) * self.interval).astype(np.int64)
+        for name in ("_index", "_x", "_y", "_keys"):
+            old = getattr(self, name)
+            new = np.empty((len(self.times), capacity), old.dtype)
+            new[:rows, :n] = old[:rows, :n]
+            setattr(self, name, new)
+        for j, replay in enumerate(self.replays):
+            self._fill(j, replay, slice(rows, None))
+
+    def _fill(self, j, replay, rows):
+        i = replay.index_at(self.times[rows])
+        self._index[rows, j] = i
+        # index -1 wraps around to the 0 on the end
+        self._x[rows, j] = np.append(replay.x, 0)[i]
+        self._y[rows, j] = np.append(replay.y, 0)[i]
+        self._keys[rows, j] = np.append(replay.key_mask, 0)[i]
+
+    def _views(self):
+        n = len(self.replays)
+        self.index = self._index[:, :n]
+        self.x = self._x[:, :n]
+        self.y = self._y[:, :n]
+        self.keys = self._keys[:, :n]
+
+    def trail_start(self, tail, rows=slice(None)):
+        """Where the trail of the last tail ms starts at each of rows.
+
+        A replay's trail is its frames from trail_start to index (inclusive):
+        the ones that have been current and aren't more than tail ms older
+        than the frame. Like index, this is (rows, replays).
+        """
+        times = self.times[rows] - tail
+        start = np.empty((len(times), len(self.replays)), np.int32)
+        for j, replay in enumerate(self.replays):
+            start[:, j] = np.searchsorted(replay.time_index, times)
+        return np.minimum(start, self.index[rows] + 1)
+
+    def __len__(self):
+        return len(self.times)
+
+    def frame_at(self, pos):
+        """The last frame at or before pos ms, start - 1 before the first."""
+        return self.start + int(np.searchsorted(self.times, pos, "right")) - 1
+
+    def previous(self, frame):
+        """index for the frame before frame, all -1 before frame 0."""
+        if frame <= 0:
+            return np.full(len(self.replays), -1, np.int32)
+        if frame > self.start:
+            return self.index[frame - 1 - self.start]
+        times = np.array([int((frame - 1) * self.interval)])
+        return np.array([replay.index_at(times)[0] for replay in self.replays])